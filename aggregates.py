@@ -0,0 +1,146 @@
+import pandas as pd
+import os
+
+CUBE_PATHS = {
+    'aspects': 'processed_reviews_aspects_count.parquet',
+    'daily': 'processed_reviews_daily_count.parquet',
+    'month_day': 'processed_reviews_month_day_count.parquet',
+    'weekday': 'processed_reviews_weekday_count.parquet',
+    'products_sentiment': 'processed_reviews_products_sentiment_count.parquet',
+}
+
+
+def count_by(df, columns):
+    counts = df.groupby(columns, observed=True).size().reset_index(name='count')
+
+    return counts.sort_values('count', ascending=False, kind='stable').reset_index(drop=True)
+
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+DATE_COLUMNS = ['reviews_day', 'month', 'day', 'hour', 'dof']
+
+
+def add_date_dimension(reviews):
+    ## calendar features are derived once here and stored with the reviews, so the charts only select and group
+    dates = reviews['reviews_date']
+    reviews = reviews.assign(
+        reviews_day=dates.dt.floor('D'),
+        month=dates.dt.month.astype('Int8'),
+        day=dates.dt.day.astype('Int8'),
+        hour=dates.dt.hour.astype('Int8'),
+        dof=pd.Categorical.from_codes(dates.dt.dayofweek.fillna(-1).astype('int8'), categories=WEEKDAYS, ordered=True),
+    )
+
+    return reviews
+
+
+def explode_categories(reviews, columns):
+    ## one row per (review, primary category); the comma-separated string is split once during precompute
+    categories = reviews['primaryCategories'].astype(str).str.split(',')
+    exploded = reviews[columns].assign(primaryCategories=categories).explode('primaryCategories')
+    exploded['primaryCategories'] = exploded['primaryCategories'].str.strip().astype('category')
+
+    return exploded
+
+
+def aspects_cube(reviews):
+    aspects = reviews[['aspects', 'sentiment_label']].explode('aspects').dropna(subset=['aspects'])
+
+    return count_by(aspects, ['aspects', 'sentiment_label'])
+
+
+def daily_cube(reviews):
+    daily = explode_categories(reviews, ['reviews_day', 'sentiment_label']).dropna(subset=['reviews_day'])
+    daily = count_by(daily, ['reviews_day', 'primaryCategories', 'sentiment_label']).rename(columns={'reviews_day': 'reviews_date'})
+
+    return daily.sort_values('reviews_date', kind='stable').reset_index(drop=True)
+
+
+def month_day_cube(reviews):
+    return count_by(reviews[['month', 'day', 'sentiment_label']].dropna(subset=['month']), ['month', 'day', 'sentiment_label'])
+
+
+def weekday_cube(reviews):
+    return count_by(reviews[['dof', 'sentiment_label']].dropna(subset=['dof']), ['dof', 'sentiment_label'])
+
+
+def products_sentiment_cube(reviews):
+    products = reviews[['id', 'sentiment_label']].astype({'id': str})
+
+    return count_by(products, ['id', 'sentiment_label'])
+
+
+## resampling rules for the reviews-over-time chart; weeks start on Monday and are labelled by it
+GRANULARITIES = {'Day': 'D', 'Week': 'W-MON', 'Month': 'MS'}
+
+
+def daily_rollup(daily):
+    ## wide form of the daily cube: a sorted, gap-free index of calendar days and one count column per (sentiment, category)
+    rollup = daily.pivot_table(index='reviews_date', columns=['sentiment_label', 'primaryCategories'], values='count',
+                               aggfunc='sum', fill_value=0, observed=True)
+
+    return rollup.sort_index().asfreq('D', fill_value=0).astype('int32')
+
+
+def rollup_series(rollup, start=None, end=None, sentiment=None, granularity='Day'):
+    ## the date range is a slice of the sorted index, so the cost depends on the number of days shown, not on the reviews
+    window = rollup.loc[start:end]
+
+    if sentiment is None:
+        window = window.T.groupby(level='primaryCategories', observed=True).sum().T
+    elif sentiment in window.columns.get_level_values('sentiment_label'):
+        window = window[sentiment]
+    else:
+        ## a sentiment the filters left no reviews for: no category columns, but the same dates
+        window = pd.DataFrame(index=window.index, columns=pd.Index([], name='primaryCategories'), dtype='int32')
+
+    ## days of each bucket inside the range; the rollup has a row for every day, so this counts index entries
+    days = pd.Series(1, index=window.index, dtype='int32')
+    full_days = days
+
+    if granularity != 'Day':
+        rule = GRANULARITIES[granularity]
+        first_day = window.index[0] if len(window) else None
+        window = window.resample(rule, label='left', closed='left').sum()
+        days = days.resample(rule, label='left', closed='left').sum()
+        full_days = pd.Series(7 if granularity == 'Week' else days.index.days_in_month, index=days.index)
+
+        ## the first bucket can start before the range: it is labelled by its first day in the range instead
+        if first_day is not None:
+            labels = days.index.where(days.index >= first_day, first_day)
+            window.index, days.index, full_days.index = labels, labels, labels
+
+    series = window.rename_axis(index='reviews_date', columns='primaryCategories').melt(value_name='count', ignore_index=False)
+    series['days'] = days.reindex(series.index).to_numpy()
+    ## the first and last buckets can cover only part of a week or month
+    series['partial'] = series['days'].to_numpy() < full_days.reindex(series.index).to_numpy()
+
+    return series.reset_index()
+
+
+CUBE_BUILDERS = {
+    'aspects': aspects_cube,
+    'daily': daily_cube,
+    'month_day': month_day_cube,
+    'weekday': weekday_cube,
+    'products_sentiment': products_sentiment_cube,
+}
+
+
+def build_cubes(reviews, bridge):
+    ## the same cubes from the stored reviews table and its review -> aspect bridge, e.g. for a filtered subset of the reviews
+    aspects = bridge.rename(columns={'aspect': 'aspects'}).merge(reviews[['review_id', 'sentiment_label']], on='review_id')
+    cubes = {name: build(reviews) for name, build in CUBE_BUILDERS.items() if name != 'aspects'}
+    cubes['aspects'] = count_by(aspects[['aspects', 'sentiment_label']], ['aspects', 'sentiment_label'])
+
+    return {name: cubes[name] for name in CUBE_BUILDERS}
+
+
+def write_cubes(reviews):
+    ## reviews holds one row per review with the aspects as a list and the date dimension columns
+    for name, build in CUBE_BUILDERS.items():
+        build(reviews).to_parquet(CUBE_PATHS[name])
+
+
+def load_cube(name, base_dir='.'):
+    return pd.read_parquet(os.path.join(base_dir, CUBE_PATHS[name]))
@@ -1,19 +1,15 @@
 import streamlit as st
-import tensorflow as tf
-import pandas as pd
 import os, sys, traceback
 
-from visualizations import (reviews_by_aspect, reviews_over_time, reviews_by_day_month, reviews_by_dof_and_sentiment,
-                            reviews_table, reviews_percentage_diff)
+from visualizations import (review_filters, reviews_by_aspect, reviews_over_time, reviews_by_day_month, reviews_by_dof_and_sentiment,
+                            reviews_table, reviews_percentage_diff, similar_reviews, performance_panel)
+from data_access import review_cubes, daily_rollup, memory_mb
+from instrumentation import start_run, finish_run, timed
 
 BASE_DIR = os.path.dirname(__file__)
-MODEL_PATH = os.path.join(BASE_DIR, 'sentiment_model.h5')
-DATA_PATH = os.path.join(BASE_DIR, 'processed_reviews.parquet')
+PERF_HISTORY = 50
 
-st.set_page_config(layout='wide')
-st.title('Amazon Reviews Dashboard')
-
-st.markdown("""
+TAB_STYLE = """
 <style>
 .stTabs [data-baseweb="tab"] {
     font-size: 1.2rem !important;
@@ -25,58 +21,89 @@ st.markdown("""
     font-size: 1.3rem !important;
 }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+def plot(name, fig, **kwargs):
+    with timed(name, 'render') as event:
+        st.plotly_chart(fig, **kwargs)
+
+    if event is not None:
+        event['payload_kb'] = round(len(fig.to_json()) / 1024, 1)
+
+def load_preprocessed_data(filters):
+    with timed('load_preprocessed_data', 'load'):
+        cubes = review_cubes(filters)
+    st.sidebar.caption(f"{int(cubes['products_sentiment']['count'].sum()):,} reviews selected")
+    st.sidebar.caption(f'Dashboard data: {memory_mb(*cubes.values()):.2f} MB in memory')
 
-@st.cache_data
-def load_preprocessed_data():
-    return pd.read_parquet(DATA_PATH)
+    return cubes
 
-@st.cache_data
-def load_sentiment_model():
-    return tf.keras.models.load_model(MODEL_PATH)
+## the Performance tab is hidden unless the page is opened with ?perf=1 (or PERF_INSTRUMENTATION=1 is set)
+perf_run = start_run('dashboard', enabled=True if st.query_params.get('perf') == '1' else None)
 
+## Streamlit ends a rerun early by raising (st.stop, a new rerun), so the run is always closed and its context variable reset
 try:
-    df = load_preprocessed_data()
-except Exception as e:
-    st.error('Failed to load data')
-    st.text(traceback.format_exc)
-    sys.exit(1)
-    
-try: 
-    model_nn = load_sentiment_model()
-except Exception as e:
-    st.error('Failed to load model')
-    st.text(traceback.format_exc())
-    sys.exit(1)
-
-tab1, tab2 = st.tabs(['📊 Reviews', '📈 Time Analysis'])
-
-with tab1:
-    col1, col2 = st.columns(2)
-
-    with col1:
-        st.header('Number of Reviews by Aspect')
-        st.plotly_chart(reviews_by_aspect(df))
-
-    with col2:
-        st.header('Number of Reviews By Sentiment and Product')
-        st.plotly_chart(reviews_table(df), use_container_width=True)
-
-    st.header('Reviews Percentage Difference')
-    products_categories = st.radio('Choose Products or Categories', ['Products', 'Categories'])
-    fig = reviews_percentage_diff(products_categories)
-    if fig:
-        st.plotly_chart(fig)
-
-with tab2:
-    st.header('Number of Reviews Over Time')
-    st.plotly_chart(reviews_over_time(df))
-
-    st.header('Number of Reviews By Day and Month')
-    st.plotly_chart(reviews_by_day_month(df))
-
-    st.header('Number of Reviews By Sentiment and Day of Week')
-    st.plotly_chart(reviews_by_dof_and_sentiment(df))
+    st.set_page_config(layout='wide')
+    st.title('Amazon Reviews Dashboard')
+
+    st.markdown(TAB_STYLE, unsafe_allow_html=True)
+
+    try:
+        filters = review_filters()
+        cubes = load_preprocessed_data(filters)
+    except Exception as e:
+        st.error('Failed to load data')
+        st.text(traceback.format_exc)
+        sys.exit(1)
+
+    tabs = st.tabs(['📊 Reviews', '📈 Time Analysis', '🔎 Similar Reviews'] + (['⏱️ Performance'] if perf_run else []))
+    tab1, tab2, tab3 = tabs[:3]
+
+    with tab1:
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.header('Number of Reviews by Aspect')
+            plot('reviews_by_aspect', reviews_by_aspect(cubes['aspects']))
+
+        with col2:
+            st.header('Number of Reviews By Sentiment and Product')
+            plot('reviews_table', reviews_table(cubes['products_sentiment']), use_container_width=True)
+
+        st.header('Reviews Percentage Difference')
+        products_categories = st.radio('Choose Products or Categories', ['Products', 'Categories'])
+        fig = reviews_percentage_diff(products_categories, filters)
+        if fig:
+            plot('reviews_percentage_diff', fig)
+
+    with tab2:
+        st.header('Number of Reviews Over Time')
+        fig = reviews_over_time(daily_rollup(filters))
+        if fig:
+            plot('reviews_over_time', fig)
+
+        st.header('Number of Reviews By Day and Month')
+        plot('reviews_by_day_month', reviews_by_day_month(cubes['month_day']))
+
+        st.header('Number of Reviews By Sentiment and Day of Week')
+        plot('reviews_by_dof_and_sentiment', reviews_by_dof_and_sentiment(cubes['weekday']))
+
+    with tab3:
+        st.header('Similar Reviews')
+        similar_df = similar_reviews()
+        if similar_df is not None:
+            st.dataframe(similar_df, hide_index=True, use_container_width=True)
+finally:
+    perf_summary = finish_run(perf_run)
+
+if perf_summary:
+    ## the run is closed before the panel is drawn, so the panel shows this rerun in full
+    history = st.session_state.setdefault('perf_runs', [])
+    history.append(perf_summary)
+    del history[:-PERF_HISTORY]
+
+    with tabs[3]:
+        performance_panel(history)
 
 
 st.markdown("""
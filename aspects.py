@@ -1,24 +1,40 @@
-import spacy
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from scipy.optimize import linear_sum_assignment
 from itertools import chain
-import streamlit as st
-
-from embeddings import load_embed_model
-
-embed_model = load_embed_model()
-
-@st.cache_resource
+import hashlib
+import os
+import numpy as np
+
+from embeddings import get_embeddings, EMBED_MODEL_NAME
+from lemma_cache import LemmaCache
+from memo import memoize
+from shards import run_sharded
+
+ASPECT_CENTROIDS_PATH = 'aspect_centroids.npz'
+ASPECT_CENTROIDS_VERSION = 1
+MISCELLANEOUS = 'miscellaneous'
+## a new phrase farther (cosine distance) from its centroid than this share of the training phrases of that cluster is miscellaneous
+ASPECT_RADIUS_QUANTILE = 0.99
+## phrase sets larger than this are clustered with MiniBatchKMeans, fed in chunks of this many phrases
+MINIBATCH_MIN_PHRASES = 200_000
+MINIBATCH_CHUNK_SIZE = 50_000
+
+SPACY_MODEL_NAME = 'en_core_web_sm'
+## lemmas only need the tagger and attribute_ruler (for POS) ahead of the lemmatizer
+LEMMA_DISABLE = ['parser', 'ner']
+LEMMA_BATCH_SIZE = 1000
+LEMMA_CACHE_PATH = os.environ.get('LEMMA_CACHE_PATH', os.path.join('lemma_cache', 'lemmas.parquet'))
+LEMMA_CACHE_MAX_ITEMS = 500_000
+
+@memoize
 def load_spacy():
-    return spacy.load("en_core_web_sm")
+    import spacy
 
-nlp = load_spacy()
+    return spacy.load(SPACY_MODEL_NAME)
 
-@st.cache_resource
-def get_kmeans_model(num_clusters, embeddings):
-    model = KMeans(n_clusters=num_clusters, random_state=123)
-    model.fit(embeddings)
-
-    return model
+@memoize
+def load_lemma_cache():
+    return LemmaCache(LEMMA_CACHE_PATH, SPACY_MODEL_NAME, max_items=LEMMA_CACHE_MAX_ITEMS)
 
 
 cluster_to_aspect = {
@@ -36,34 +52,141 @@ cluster_to_aspect = {
     11:'Quality / Brand Preception'
 }
 
+def lemmatize_phrases(phrases, batch_size=LEMMA_BATCH_SIZE):
+    lemmas = []
+    for doc in load_spacy().pipe(phrases, batch_size=batch_size, disable=LEMMA_DISABLE):
+        lemmas.append(' '.join(token.lemma_ for token in doc if not token.is_stop and token.is_alpha))
+
+    return lemmas
+
+
+def normalize_phrase_lists(phrase_lists, workers=None):
+    ## every distinct phrase in the corpus is lemmatized once; repeats and phrases seen in earlier runs come from the cache
+    phrase_lists = [[phrase.lower() for phrase in phrases] for phrases in phrase_lists]
+    cache = load_lemma_cache()
+    lemmas = cache.get_many(list(chain.from_iterable(phrase_lists)), lambda missing: run_sharded(lemmatize_phrases, missing, workers=workers))
+    cache.save()
+
+    normalized, offset = [], 0
+    for phrases in phrase_lists:
+        normalized.append([lemma for lemma in lemmas[offset:offset + len(phrases)] if lemma])
+        offset += len(phrases)
+
+    return normalized
+
+
 def normalize_phrases(phrases):
-    clean_phrases = []
-    for phrase in phrases:
-        doc = nlp(phrase.lower())
-        lemmas = [token.lemma_ for token in doc if not token.is_stop and token.is_alpha]
-        clean = ' '.join(lemmas)
-        if clean:
-            clean_phrases.append(clean)
+    return normalize_phrase_lists([phrases])[0]
+
+
+def embed_phrases(phrases):
+    return get_embeddings(phrases, normalize_embeddings=True, show_progress_bar=False)
+
+
+def fit_kmeans(phrases, num_clusters, minibatch=None, random_state=123):
+    ## returns the fitted model and the cluster of every phrase
+    minibatch = len(phrases) > MINIBATCH_MIN_PHRASES if minibatch is None else minibatch
+
+    if not minibatch:
+        model = KMeans(n_clusters=num_clusters, random_state=random_state).fit(embed_phrases(phrases))
+        return model, model.labels_
+
+    ## streaming fit: only one chunk of embeddings is in memory at a time
+    model = MiniBatchKMeans(n_clusters=num_clusters, random_state=random_state, batch_size=4096, n_init=3)
+    for start in range(0, len(phrases), MINIBATCH_CHUNK_SIZE):
+        model.partial_fit(embed_phrases(phrases[start:start + MINIBATCH_CHUNK_SIZE]))
+
+    labels = np.concatenate([model.predict(embed_phrases(phrases[start:start + MINIBATCH_CHUNK_SIZE]))
+                             for start in range(0, len(phrases), MINIBATCH_CHUNK_SIZE)])
+
+    return model, labels
+
+
+def match_labels(centroids, previous):
+    ## carries the aspect names over from the previous fit by matching each new centroid to its closest old one
+    if previous is None or len(previous['centroids']) != len(centroids):
+        return [cluster_to_aspect.get(i, f'Aspect {i}') for i in range(len(centroids))]
+
+    rows, cols = linear_sum_assignment(-(centroids @ previous['centroids'].T))
+    labels = [None] * len(centroids)
+    for row, col in zip(rows, cols):
+        labels[row] = str(previous['labels'][col])
+
+    return labels
+
+
+def cluster_radii(phrases, assignments, centroids):
+    radii = np.zeros(len(centroids), dtype=np.float32)
+    for start in range(0, len(phrases), MINIBATCH_CHUNK_SIZE):
+        embeddings = embed_phrases(phrases[start:start + MINIBATCH_CHUNK_SIZE])
+        clusters = assignments[start:start + MINIBATCH_CHUNK_SIZE]
+        distances = 1 - np.einsum('ij,ij->i', embeddings, centroids[clusters])
+        for cluster in np.unique(clusters):
+            radius = np.quantile(distances[clusters == cluster], ASPECT_RADIUS_QUANTILE)
+            radii[cluster] = max(radii[cluster], radius)
+
+    return radii
+
+
+def fit_aspect_centroids(all_phrases, num_clusters=12, minibatch=None, previous=None):
+    ## repeated phrases are kept, so frequent phrases weigh more in the fit
+    phrases = list(all_phrases)
+    model, assignments = fit_kmeans(phrases, num_clusters, minibatch=minibatch)
+
+    centroids = model.cluster_centers_.astype(np.float32)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    aspect_model = {
+        'centroids': centroids,
+        'labels': np.array(match_labels(centroids, previous)),
+        'radii': cluster_radii(phrases, assignments, centroids),
+    }
+
+    return aspect_model, dict(zip(phrases, aspect_model['labels'][assignments]))
+
+
+def save_aspect_centroids(aspect_model, path=ASPECT_CENTROIDS_PATH):
+    fingerprint = hashlib.blake2b(aspect_model['centroids'].tobytes(), digest_size=8).hexdigest()
+    np.savez(path, **aspect_model, version=ASPECT_CENTROIDS_VERSION, embed_model=EMBED_MODEL_NAME, fingerprint=fingerprint)
+
+    return path
+
+
+def load_aspect_centroids(path=ASPECT_CENTROIDS_PATH):
+    ## centroids from another format version or embedding model are not comparable, so they count as missing
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as stored:
+        if int(stored['version']) != ASPECT_CENTROIDS_VERSION or str(stored['embed_model']) != EMBED_MODEL_NAME:
+            return None
+
+        return {name: stored[name] for name in ['centroids', 'labels', 'radii']}
+
 
-    return clean_phrases
+def assign_aspects(phrases, aspect_model, max_distance=None):
+    ## nearest centroid by cosine distance; beyond the cluster's radius (or max_distance) a phrase is miscellaneous
+    phrases = list(phrases)
+    if not phrases:
+        return {}
 
+    similarity = embed_phrases(phrases) @ aspect_model['centroids'].T
+    nearest = similarity.argmax(axis=1)
+    distances = 1 - similarity[np.arange(len(phrases)), nearest]
+    limits = aspect_model['radii'][nearest] if max_distance is None else max_distance
 
-def cluster_aspects(all_phrases, num_clusters=12):
-    phrase_embeddings = embed_model.encode(all_phrases, normalize_embeddings=True)
-    cluster_model = get_kmeans_model(num_clusters, phrase_embeddings)
-    cluster_assignment = cluster_model.labels_
+    aspects = np.where(distances <= limits, aspect_model['labels'][nearest], MISCELLANEOUS)
 
-    clusters = {}
+    return dict(zip(phrases, aspects.tolist()))
 
-    for phrase, cluster_id in zip(all_phrases, cluster_assignment):
-        clusters.setdefault(cluster_id, []).append(phrase)
 
-    phrase_to_aspect = {phrase: cluster_to_aspect[cluster_id] for phrase, cluster_id in zip(all_phrases, cluster_assignment)}
+def cluster_aspects(all_phrases, num_clusters=12, minibatch=None):
+    _, phrase_to_aspect = fit_aspect_centroids(all_phrases, num_clusters, minibatch=minibatch)
 
     return phrase_to_aspect
 
 
 def map_to_aspects(phrase_to_aspect, phrases):
-    aspects = [phrase_to_aspect.get(p, 'miscellaneous') for p in phrases]
+    aspects = [phrase_to_aspect.get(p, MISCELLANEOUS) for p in phrases]
     
     return aspects
\ No newline at end of file
@@ -0,0 +1,351 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from itertools import chain
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import streamlit as st
+from streamlit import logger as st_logger
+
+import aspects
+import data_access
+import embeddings
+import pros_cons
+import visualizations
+from aggregates import add_date_dimension, rollup_series, CUBE_BUILDERS, GRANULARITIES
+from aspects import cluster_aspects, map_to_aspects, normalize_phrase_lists, load_lemma_cache
+from embeddings import extract_keywords_batch
+from incremental import apply_count_delta, empty_state, SENTIMENTS
+from pipeline import reset_peak_memory, peak_memory_mb
+from precompute import prepare_text, PARTITION_COLUMNS
+from preprocessing import add_percentage_columns
+from pros_cons import process_pros_cons
+from review_store import write_review_tables, REVIEWS_PATH, REVIEW_ASPECTS_PATH
+
+EMBEDDING_DIM = 384
+HASHED_WORDS = 1 << 15
+
+CATEGORIES = ['Electronics', 'Health & Beauty', 'Toys & Games,Electronics', 'Office Supplies,Electronics', 'Electronics,Hardware',
+              'Animals & Pet Supplies', 'Home & Garden', 'Electronics,Media']
+BRANDS = ['Amazon', 'Amazonbasics', 'Fire', 'Kindle', 'Echo']
+ASPECT_WORDS = ['battery', 'price', 'screen', 'sound', 'setup', 'shipping', 'speaker', 'camera', 'apps', 'alexa', 'charger', 'size',
+                'quality', 'tablet', 'kids', 'reader', 'display', 'remote', 'voice', 'wifi']
+POSITIVE_WORDS = ['great', 'excellent', 'amazing', 'good', 'perfect', 'fantastic', 'easy', 'love']
+NEGATIVE_WORDS = ['terrible', 'poor', 'awful', 'bad', 'disappointing', 'broken', 'slow', 'hate']
+NEUTRAL_WORDS = ['okay', 'fine', 'average', 'standard', 'normal', 'expected']
+## roughly the Datafiniti rating mix, from 1 to 5 stars
+RATING_SHARES = [0.03, 0.02, 0.04, 0.23, 0.68]
+SENTENCE_TEMPLATES = ['The {aspect} is {word}.', 'I think the {aspect} is {word}', '{word} {aspect} for the price!',
+                      'My {aspect} was {word} after a week.', 'Overall a {word} {aspect}.']
+
+## a result must also grow by at least this much to count as a regression, so millisecond timings do not fail the run on noise
+NOISE_SECONDS = 0.05
+NOISE_MB = 16
+
+
+def synthetic_reviews(n_rows, seed=123):
+    ## same columns and dtypes as data_loader.load_data_and_products, with sentences built from aspect and opinion words
+    rng = np.random.default_rng(seed)
+    n_products = int(np.clip(n_rows // 400, 20, 5_000))
+
+    product_ids = np.array([f'AV{i:018d}' for i in range(n_products)])
+    products = pd.DataFrame({'id': product_ids, 'name': [f'{BRANDS[i % len(BRANDS)]} device {i}' for i in range(n_products)]})
+    product_category = rng.choice(CATEGORIES, n_products)
+    product_brand = rng.choice(BRANDS, n_products)
+
+    product = rng.zipf(1.3, n_rows) % n_products
+    ratings = rng.choice(np.arange(1, 6), n_rows, p=RATING_SHARES).astype(np.int8)
+    seconds = rng.integers(pd.Timestamp('2014-01-01').value // 10**9, pd.Timestamp('2019-03-01').value // 10**9, n_rows)
+    dates = pd.to_datetime(seconds, unit='s').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    words = {1: NEGATIVE_WORDS, 2: NEGATIVE_WORDS, 3: NEUTRAL_WORDS + POSITIVE_WORDS + NEGATIVE_WORDS, 4: POSITIVE_WORDS, 5: POSITIVE_WORDS}
+    n_sentences = rng.integers(1, 7, n_rows)
+    texts = []
+    for rating, count, row_seed in zip(ratings, n_sentences, rng.integers(0, 2**32, n_rows)):
+        row_rng = np.random.default_rng(row_seed)
+        opinion = words[int(rating)]
+        texts.append(' '.join(SENTENCE_TEMPLATES[row_rng.integers(len(SENTENCE_TEMPLATES))].format(
+            aspect=ASPECT_WORDS[row_rng.integers(len(ASPECT_WORDS))], word=opinion[row_rng.integers(len(opinion))]) for _ in range(count)))
+
+    reviews = pd.DataFrame({
+        'id': pd.Categorical(product_ids[product]),
+        'brand': pd.Categorical(product_brand[product]),
+        'primaryCategories': pd.Categorical(product_category[product]),
+        'reviews_date': dates,
+        'reviews_rating': ratings,
+        'reviews_text': texts,
+        'reviews_title': [f'{ASPECT_WORDS[i % len(ASPECT_WORDS)]} review' for i in product],
+    })
+
+    return reviews, products
+
+
+class HashingEmbedder:
+    ## deterministic stand-in for MiniLM: the mean of fixed random vectors of the hashed words, so texts sharing words are close
+    def __init__(self, dim=EMBEDDING_DIM, seed=123):
+        self.word_vectors = np.random.default_rng(seed).standard_normal((HASHED_WORDS, dim)).astype(np.float32)
+
+    def embed(self, texts, normalize=True):
+        tokens = [re.findall(r'\w+', str(text).lower()) for text in texts]
+        counts = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        ids = np.fromiter((zlib.crc32(word.encode()) % HASHED_WORDS for word in chain.from_iterable(tokens)), dtype=np.int64, count=counts.sum())
+
+        vectors = np.zeros((len(texts), self.word_vectors.shape[1]), dtype=np.float32)
+        rows = np.repeat(np.arange(len(texts)), counts)
+        np.add.at(vectors, rows, self.word_vectors[ids])
+        vectors /= np.maximum(counts, 1)[:, None]
+
+        if normalize:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms == 0, 1, norms)
+
+        return vectors
+
+
+class LexiconSentiment:
+    ## stand-in for VADER: compound score from the opinion words in the sentence
+    SCORES = {**{word: 0.6 for word in POSITIVE_WORDS}, **{word: -0.6 for word in NEGATIVE_WORDS}}
+
+    def polarity_scores(self, text):
+        score = sum(self.SCORES.get(word, 0.0) for word in re.findall(r'\w+', text.lower()))
+
+        return {'compound': float(np.tanh(score))}
+
+
+def stub_spacy(lemmatizer=False):
+    import spacy
+    from spacy.language import Language
+
+    @Language.component('benchmark_lemmatizer')
+    def benchmark_lemmatizer(doc):
+        for token in doc:
+            token.lemma_ = token.lower_[:-1] if token.lower_.endswith('s') and len(token) > 3 else token.lower_
+        return doc
+
+    nlp = spacy.blank('en')
+    nlp.add_pipe('benchmark_lemmatizer' if lemmatizer else 'sentencizer')
+
+    return nlp
+
+
+def install_stubs():
+    ## swaps the downloaded models for deterministic stand-ins; the code around them is what gets measured
+    embedder = HashingEmbedder()
+    sentence_nlp, lemma_nlp = stub_spacy(), stub_spacy(lemmatizer=True)
+
+    embeddings.load_keybert = lambda: SimpleNamespace(model=embedder)
+    aspects.get_embeddings = lambda texts, normalize_embeddings=False, **kwargs: embedder.embed(texts, normalize=normalize_embeddings)
+    pros_cons.load_spacy_model = lambda: sentence_nlp
+    pros_cons.load_sentiment_analyzer = lambda: LexiconSentiment()
+    aspects.load_spacy = lambda: lemma_nlp
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return 0.0
+
+
+def measure(results, name, func, repeat, setup=None):
+    ## best wall time over the repeats; memory is the peak RSS above the starting RSS during the first repeat
+    timings, peak = [], None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started_rss = rss_mb()
+        reset_peak_memory()
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+        if peak is None:
+            peak = max((peak_memory_mb() or started_rss) - started_rss, 0.0)
+
+    results[name] = {'seconds': round(min(timings), 4), 'peak_mb': round(peak, 1)}
+    print(f"  {name:<36} {min(timings):>9.3f}s {peak:>9.1f} MB", flush=True)
+
+    return result
+
+
+def processed_reviews(cleaned, normalized, phrase_to_aspect):
+    processed = cleaned.copy()
+    processed['aspects'] = [map_to_aspects(phrase_to_aspect, phrases) for phrases in normalized]
+    processed['sentiment_label'] = pd.Categorical(processed['sentiment_label'].astype(str), categories=SENTIMENTS)
+    processed['reviews_date'] = pd.to_datetime(processed['reviews_date'], format='ISO8601', utc=True, errors='coerce')
+    processed['review_key'] = np.arange(len(processed), dtype=np.uint64)
+    processed['content_hash'] = processed['review_key']
+
+    return processed[PARTITION_COLUMNS]
+
+
+def run_stages(n_rows, repeat, workdir):
+    results = {}
+    reviews, products = synthetic_reviews(n_rows)
+
+    cleaned = measure(results, 'clean_text', lambda: prepare_text(reviews.copy()), repeat)
+    pros_cons_df = measure(results, 'process_pros_cons',
+                           lambda: process_pros_cons(cleaned[['reviews_text_clean', 'sentiment']].copy()), repeat)
+    key_phrases = measure(results, 'extract_keywords',
+                          lambda: extract_keywords_batch(pros_cons_df['pros'].to_list(), pros_cons_df['cons'].to_list(), cleaned['sentiment'].to_list()),
+                          repeat)
+
+    def fresh_lemma_cache():
+        ## every repeat starts from an empty lemma cache, as on a first run
+        aspects.LEMMA_CACHE_PATH = os.path.join(workdir, 'lemma_cache', 'lemmas.parquet')
+        shutil.rmtree(os.path.dirname(aspects.LEMMA_CACHE_PATH), ignore_errors=True)
+        load_lemma_cache.clear()
+
+    normalized = measure(results, 'normalize_phrases', lambda: normalize_phrase_lists(key_phrases), repeat, setup=fresh_lemma_cache)
+    all_phrases = list(chain.from_iterable(normalized))
+    phrase_to_aspect = measure(results, 'cluster_aspects', lambda: cluster_aspects(all_phrases), repeat)
+
+    processed = processed_reviews(cleaned, normalized, phrase_to_aspect)
+    exported = measure(results, 'add_date_dimension', lambda: add_date_dimension(processed), repeat)
+
+    cubes = {}
+    for name, build in CUBE_BUILDERS.items():
+        cubes[name] = measure(results, f'{name}_cube', lambda: build(exported), repeat)
+
+    measure(results, 'write_review_tables',
+            lambda: write_review_tables(exported, os.path.join(workdir, REVIEWS_PATH), os.path.join(workdir, REVIEW_ASPECTS_PATH)), repeat)
+
+    added = processed.merge(products, on='id', how='left')
+    removed = empty_state().merge(products, on='id', how='left')
+    for name, by in [('categories_count', 'primaryCategories'), ('products_count', 'name')]:
+        cubes[name] = measure(results, name, lambda: add_percentage_columns(apply_count_delta(None, added, removed, by)), repeat)
+
+    return results, products, cubes
+
+
+def check_filtered_rollup():
+    ## a sentiment the filters leave no reviews for still charts, as an empty series
+    rollup = data_access.daily_rollup(data_access.ReviewFilters(sentiments=('Negative',)))
+    for granularity in GRANULARITIES:
+        series = rollup_series(rollup, sentiment='Positive', granularity=granularity)
+        if len(series) or list(series.columns) != ['reviews_date', 'primaryCategories', 'count', 'days', 'partial']:
+            raise RuntimeError(f'rollup_series returned {list(series.columns)} with {len(series)} rows for a filtered-out sentiment')
+
+
+def run_charts(results, repeat, workdir, products, cubes):
+    ## the charts read the product dimension and the percentage tables from disk, so they are pointed at synthetic copies
+    products_path = os.path.join(workdir, 'original_data.parquet')
+    products.assign(primaryCategories='Electronics').to_parquet(products_path)
+    data_access.ORIGINAL_DATA_PATH = products_path
+    daily_path = os.path.join(workdir, 'daily_count.parquet')
+    cubes['daily'].to_parquet(daily_path)
+    data_access.DAILY_CUBE_PATH = daily_path
+    data_access.REVIEWS_PATH = os.path.join(workdir, REVIEWS_PATH)
+    data_access.REVIEW_ASPECTS_PATH = os.path.join(workdir, REVIEW_ASPECTS_PATH)
+    data_access.clear_cache()
+
+    for table, (path, id_col) in list(visualizations.PERCENTAGE_TABLES.items()):
+        table_path = os.path.join(workdir, os.path.basename(path))
+        cubes['products_count' if table == 'Products' else 'categories_count'].to_parquet(table_path)
+        visualizations.PERCENTAGE_TABLES[table] = (table_path, id_col)
+
+    ## the charts run without a Streamlit session, which Streamlit warns about on every widget; the level is set after
+    ## Streamlit has read its config, as reading it resets the level
+    st.config.get_option('logger.level')
+    st_logger.set_log_level('error')
+
+    charts = [
+        ('reviews_by_aspect', lambda: visualizations.reviews_by_aspect(cubes['aspects'])),
+        ('reviews_over_time', lambda: visualizations.reviews_over_time(data_access.daily_rollup())),
+        ('reviews_by_day_month', lambda: visualizations.reviews_by_day_month(cubes['month_day'])),
+        ('reviews_by_dof_and_sentiment', lambda: visualizations.reviews_by_dof_and_sentiment(cubes['weekday'])),
+        ('reviews_table', lambda: visualizations.reviews_table(cubes['products_sentiment'])),
+        ('reviews_percentage_diff[Products]', lambda: visualizations.reviews_percentage_diff('Products')),
+        ('reviews_percentage_diff[Categories]', lambda: visualizations.reviews_percentage_diff('Categories')),
+    ]
+
+    for name, build in charts:
+        ## cold caches each time: st.cache_data would otherwise answer every repeat after the first
+        measure(results, name, build, repeat, setup=lambda: (st.cache_data.clear(), data_access.clear_cache()))
+
+    ## one category over a year: a partition and a date slice of the reviews dataset
+    filters = data_access.ReviewFilters(categories=('Health & Beauty',), start='2017-01-01', end='2017-12-31')
+    measure(results, 'review_cubes[filtered]', lambda: data_access.review_cubes(filters), repeat, setup=data_access.clear_cache)
+
+    check_filtered_rollup()
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+
+    for key, current in results.items():
+        previous = baseline.get('results', {}).get(key)
+        if previous is None:
+            continue
+
+        slower = current['seconds'] - previous['seconds']
+        if slower > NOISE_SECONDS and current['seconds'] > previous['seconds'] * (1 + threshold):
+            regressions.append(f"{key}: {previous['seconds']:.3f}s -> {current['seconds']:.3f}s")
+
+        grown = current['peak_mb'] - previous['peak_mb']
+        if grown > NOISE_MB and current['peak_mb'] > previous['peak_mb'] * (1 + threshold):
+            regressions.append(f"{key}: {previous['peak_mb']:.1f} MB -> {current['peak_mb']:.1f} MB")
+
+    return regressions
+
+
+def run(sizes, repeat, output, baseline_path, threshold):
+    install_stubs()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_rows in sizes:
+            print(f'{n_rows} synthetic reviews', flush=True)
+            stage_results, products, cubes = run_stages(n_rows, repeat, workdir)
+            run_charts(stage_results, repeat, workdir, products, cubes)
+            results.update({f'{n_rows}/{name}': result for name, result in stage_results.items()})
+
+    report = {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                 'machine': platform.machine(), 'cpus': os.cpu_count(), 'repeat': repeat, 'sizes': sizes},
+        'results': results,
+    }
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved {output}')
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), threshold)
+
+        if regressions:
+            print(f'{len(regressions)} regressions beyond {threshold:.0%} of {baseline_path}:')
+            print('\n'.join(f'  {regression}' for regression in regressions))
+            return 1
+
+        print(f'No regressions beyond {threshold:.0%} of {baseline_path}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory-profile the precompute stages and the dashboard charts on synthetic reviews')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000], help='numbers of synthetic reviews, e.g. 10000 100000 1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='pipeline_benchmark.json', help='JSON file for the results')
+    parser.add_argument('--baseline', help='earlier results JSON to compare against; the run fails on regressions')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown or memory growth over the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    sys.exit(run(args.sizes, args.repeat, args.output, args.baseline, args.threshold))
@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from preprocessing import clean_text, clean_text_series, rating_to_sentiment, ratings_to_sentiment
+
+
+def sample_reviews(n_rows, seed=123):
+    original = pd.read_parquet(os.path.join(BASE_DIR, 'original_data.parquet'), columns=['reviews.text', 'reviews.rating'])
+    sample = original.sample(n=n_rows, replace=True, random_state=seed).reset_index(drop=True)
+    sample.columns = ['reviews_text', 'reviews_rating']
+
+    return sample
+
+
+def best_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+
+    return min(timings), result
+
+
+def run(sizes, repeat):
+    print(f"{'rows':>10} {'function':<20} {'row-wise':>10} {'columnar':>10} {'speedup':>8}")
+
+    for n_rows in sizes:
+        df = sample_reviews(n_rows)
+
+        cases = [
+            ('clean_text', lambda: df['reviews_text'].apply(clean_text), lambda: clean_text_series(df['reviews_text'])),
+            ('rating_to_sentiment', lambda: df['reviews_rating'].apply(rating_to_sentiment), lambda: ratings_to_sentiment(df['reviews_rating'])),
+        ]
+
+        for name, row_wise, columnar in cases:
+            row_time, expected = best_time(row_wise, repeat)
+            columnar_time, result = best_time(columnar, repeat)
+
+            if list(expected) != list(result):
+                raise AssertionError(f'{name}: columnar output differs from the row-wise output at {n_rows} rows')
+
+            print(f'{n_rows:>10} {name:<20} {row_time:>9.2f}s {columnar_time:>9.2f}s {row_time / columnar_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare row-wise and columnar text cleaning / sentiment labelling')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    run(args.sizes, args.repeat)
@@ -0,0 +1,92 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from sentiment_inference import export_h5_weights, load_classifier, WEIGHT_DTYPES
+
+MODEL_PATH = os.path.join(BASE_DIR, 'sentiment_model.h5')
+
+
+def sample_inputs(n_rows, input_dim, embeddings_path=None, seed=123):
+    if embeddings_path:
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        return np.asarray(embeddings[:n_rows], dtype=np.float32)
+
+    ## MiniLM embeddings are roughly unit-norm, so random directions are a fair stand-in
+    X = np.random.default_rng(seed).standard_normal((n_rows, input_dim)).astype(np.float32)
+
+    return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+
+def best_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+
+    return min(timings), result
+
+
+def load_keras_model():
+    started = time.perf_counter()
+    try:
+        import keras
+    except ImportError:
+        return None, None
+
+    model = keras.models.load_model(MODEL_PATH, compile=False)
+
+    return model, time.perf_counter() - started
+
+
+def run(n_rows, repeat, embeddings_path, atol):
+    keras_model, keras_load_time = load_keras_model()
+    if keras_model is None:
+        print('keras is not installed; only the NumPy timings are reported')
+    else:
+        print(f'keras import + load: {keras_load_time:.2f}s')
+
+    print(f"{'weights':<8} {'file':>9} {'load':>7} {'predict':>9} {'max |diff|':>11} {'labels agree':>13}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        expected = None
+
+        for dtype in WEIGHT_DTYPES:
+            path = export_h5_weights(MODEL_PATH, os.path.join(tmp, f'sentiment_model_{dtype}.npz'), dtype=dtype)
+            load_time, classifier = best_time(lambda: load_classifier(path), repeat)
+            X = sample_inputs(n_rows, classifier.input_dim, embeddings_path)
+
+            if expected is None and keras_model is not None:
+                keras_time, expected = best_time(lambda: keras_model.predict(X, batch_size=8192, verbose=0), repeat)
+                print(f"{'keras':<8} {'-':>9} {'-':>7} {keras_time:>8.3f}s")
+
+            predict_time, probabilities = best_time(lambda: classifier.predict_proba(X), repeat)
+            line = f'{dtype:<8} {os.path.getsize(path) / 1024:>7.0f}KB {load_time * 1000:>5.1f}ms {predict_time:>8.3f}s'
+
+            if expected is not None:
+                max_diff = np.abs(probabilities - expected).max()
+                agreement = (probabilities.argmax(axis=1) == expected.argmax(axis=1)).mean()
+                line += f' {max_diff:>11.2e} {agreement:>12.2%}'
+
+                if dtype == 'float32' and max_diff > atol:
+                    raise AssertionError(f'float32 NumPy predictions differ from Keras by {max_diff:.2e} (tolerance {atol:.0e})')
+
+            print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the NumPy sentiment classifier against the Keras model')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--embeddings', help='optional .npy of review embeddings to score instead of random unit vectors')
+    parser.add_argument('--atol', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    run(args.rows, args.repeat, args.embeddings, args.atol)
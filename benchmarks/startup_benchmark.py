@@ -0,0 +1,49 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['tensorflow', 'torch', 'spacy', 'kagglehub', 'sentence_transformers', 'keybert', 'nltk']
+
+## run in a fresh interpreter each time so nothing is already imported or cached
+PROBE = """
+import json, sys, time, warnings
+warnings.filterwarnings('ignore')
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+"""
+
+
+def measure(module, repeat):
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    timings, heavy = [], []
+
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], cwd=BASE_DIR, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'importing {module} failed:\n{result.stderr}')
+
+        measurement = json.loads(result.stdout.strip().splitlines()[-1])
+        timings.append(measurement['seconds'])
+        heavy = measurement['heavy']
+
+    return statistics.median(timings), heavy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure cold import time of the dashboard and the pipeline modules')
+    parser.add_argument('--modules', nargs='+', default=['app', 'embeddings', 'aspects', 'pros_cons'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'module':<12} {'import':>8}  heavy modules loaded")
+    for module in args.modules:
+        seconds, heavy = measure(module, args.repeat)
+        print(f"{module:<12} {seconds:>7.2f}s  {', '.join(heavy) or '-'}")
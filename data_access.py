@@ -0,0 +1,217 @@
+import os
+import threading
+from collections import namedtuple, OrderedDict
+from functools import reduce
+import operator
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from similarity_index import load_index, EMBEDDINGS_PATH, IVF_PATH
+from instrumentation import count
+from aggregates import daily_rollup as build_daily_rollup, build_cubes, CUBE_PATHS
+from review_store import review_dataset, read_reviews as read_review_dataset, REVIEWS_PATH, REVIEW_ASPECTS_PATH, PARTITION_COLUMN
+from preprocessing import add_percentage_columns
+from incremental import SENTIMENTS
+from memo import memoize
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ORIGINAL_DATA_PATH = 'original_data.parquet'
+DAILY_CUBE_PATH = CUBE_PATHS['daily']
+## tables (one entry per file and column projection) kept in memory; the least recently used ones are dropped first
+TABLE_CACHE_SIZE = int(os.environ.get('TABLE_CACHE_SIZE', '32'))
+## filtered views are kept per filter combination; the least recently used ones are dropped first
+FILTER_CACHE_SIZE = int(os.environ.get('FILTER_CACHE_SIZE', '32'))
+## the only review columns the cubes are built from
+CUBE_COLUMNS = ['review_id', 'id', 'primaryCategories', 'sentiment_label', 'reviews_day', 'month', 'day', 'dof']
+
+## categories, products (ids) and sentiments are tuples and start and end ISO dates; an empty field does not filter
+ReviewFilters = namedtuple('ReviewFilters', ['categories', 'products', 'sentiments', 'start', 'end'], defaults=((), (), (), None, None))
+NO_FILTERS = ReviewFilters()
+
+_lock = threading.Lock()
+_tables = OrderedDict()
+_lookups = {}
+
+
+def _resolve(path):
+    return path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+
+
+def read_table(path, columns=None):
+    ## tables are read once per process and re-read when the file's mtime changes or they were evicted
+    full_path = _resolve(path)
+    mtime = os.stat(full_path).st_mtime_ns
+    key = (full_path, tuple(columns) if columns else None)
+
+    with _lock:
+        cached = _tables.get(key)
+        hit = cached is not None and cached[0] == mtime
+        if hit:
+            _tables.move_to_end(key)
+    if hit:
+        count('read_table hits')
+        return cached[1]
+
+    count('read_table misses')
+    df = pd.read_parquet(full_path, columns=columns)
+
+    with _lock:
+        _tables[key] = (mtime, df)
+        _tables.move_to_end(key)
+        while len(_tables) > TABLE_CACHE_SIZE:
+            _tables.popitem(last=False)
+
+    return df
+
+
+def _lookup(name, path, build):
+    mtime = os.stat(_resolve(path)).st_mtime_ns
+
+    with _lock:
+        cached = _lookups.get(name)
+    if cached is not None and cached[0] == mtime:
+        count(f'{name} hits')
+        return cached[1]
+
+    count(f'{name} misses')
+    lookup = build()
+
+    with _lock:
+        _lookups[name] = (mtime, lookup)
+
+    return lookup
+
+
+def _product_dimension():
+    products = read_table(ORIGINAL_DATA_PATH, columns=['id', 'name', 'primaryCategories']).drop_duplicates('id')
+
+    return products.astype('category').set_index('id')
+
+
+def product_names():
+    return _lookup('product_names', ORIGINAL_DATA_PATH, lambda: _product_dimension()['name'])
+
+
+def product_categories():
+    return _lookup('product_categories', ORIGINAL_DATA_PATH, lambda: _product_dimension()['primaryCategories'])
+
+
+def daily_rollup(filters=NO_FILTERS):
+    ## built once per daily cube file (or filter combination); every reviews-over-time interaction only slices and resamples it
+    if filters == NO_FILTERS:
+        return _lookup('daily_rollup', DAILY_CUBE_PATH, lambda: build_daily_rollup(read_table(DAILY_CUBE_PATH)))
+
+    return _filtered_rollup(filters)
+
+
+def read_reviews(columns=None):
+    ## the whole reviews dataset in review_id order, so row i is review i
+    name = 'reviews:' + ','.join(columns or [])
+
+    return _lookup(name, REVIEWS_PATH, lambda: read_review_dataset(_resolve(REVIEWS_PATH), columns=columns))
+
+
+def category_partitions():
+    ## partition values are the reviews' category lists, e.g. 'Toys & Games,Electronics'
+    def build():
+        fragments = review_dataset(_resolve(REVIEWS_PATH)).get_fragments()
+        return sorted({ds.get_partition_keys(fragment.partition_expression)[PARTITION_COLUMN] for fragment in fragments})
+
+    return _lookup('category_partitions', REVIEWS_PATH, build)
+
+
+def category_options():
+    return sorted({category.strip() for partition in category_partitions() for category in partition.split(',')})
+
+
+def filter_expression(filters):
+    ## the category filter prunes whole partitions and the date filter skips row groups by their statistics, as rows are
+    ## sorted by date within each partition; products and sentiments are matched on the rows that are left
+    conditions = []
+
+    if filters.categories:
+        selected = set(filters.categories)
+        partitions = [partition for partition in category_partitions() if selected & {category.strip() for category in partition.split(',')}]
+        conditions.append(ds.field(PARTITION_COLUMN).isin(partitions))
+    if filters.products:
+        conditions.append(ds.field('id').isin(list(filters.products)))
+    if filters.sentiments:
+        conditions.append(ds.field('sentiment_label').isin(list(filters.sentiments)))
+    if filters.start:
+        conditions.append(ds.field('reviews_day') >= pa.scalar(pd.Timestamp(filters.start, tz='UTC')))
+    if filters.end:
+        conditions.append(ds.field('reviews_day') <= pa.scalar(pd.Timestamp(filters.end, tz='UTC')))
+
+    return reduce(operator.and_, conditions) if conditions else None
+
+
+def _data_signature():
+    return [os.stat(_resolve(path)).st_mtime_ns for path in (REVIEWS_PATH, REVIEW_ASPECTS_PATH, ORIGINAL_DATA_PATH)]
+
+
+def _review_aspects(review_ids):
+    ## the bridge is sorted by review_id and a category's reviews have consecutive ids, so the id range skips row groups
+    expression = ds.field('review_id').isin(review_ids.to_numpy())
+    if len(review_ids):
+        expression = (ds.field('review_id') >= int(review_ids.iat[0])) & (ds.field('review_id') <= int(review_ids.iat[-1])) & expression
+
+    return ds.dataset(_resolve(REVIEW_ASPECTS_PATH), format='parquet').to_table(filter=expression).to_pandas()
+
+
+@memoize(maxsize=FILTER_CACHE_SIZE, key=lambda filters: (filters, _data_signature()))
+def _filtered_cubes(filters):
+    count('filtered queries')
+    reviews = read_review_dataset(_resolve(REVIEWS_PATH), columns=CUBE_COLUMNS, expression=filter_expression(filters))
+    cubes = build_cubes(reviews, _review_aspects(reviews['review_id']))
+
+    if filters.categories:
+        ## a review listed under several categories only counts under the selected ones over time
+        daily = cubes['daily']
+        cubes['daily'] = daily[daily['primaryCategories'].isin(filters.categories)].reset_index(drop=True)
+
+    return cubes
+
+
+@memoize(maxsize=FILTER_CACHE_SIZE, key=lambda filters: (filters, _data_signature()))
+def _filtered_rollup(filters):
+    return build_daily_rollup(_filtered_cubes(filters)['daily'])
+
+
+@memoize(maxsize=FILTER_CACHE_SIZE, key=lambda filters, by: (filters, by, _data_signature()))
+def filtered_percentage_table(filters, by):
+    ## the same table as the precomputed products or categories one, from the filtered product x sentiment cube
+    products = _filtered_cubes(filters)['products_sentiment']
+    keys = products['id'].map(product_names() if by == 'name' else product_categories()).astype(str).rename(by)
+
+    counts = products.groupby([keys, 'sentiment_label'], observed=True)['count'].sum().unstack('sentiment_label', fill_value=0)
+    counts = counts.reindex(columns=SENTIMENTS, fill_value=0).astype(float)
+    counts.columns.name = 'sentiment_label'
+
+    return add_percentage_columns(counts.reset_index())
+
+
+def review_cubes(filters=NO_FILTERS):
+    ## unfiltered views use the precomputed cubes; filtered ones are built from only the rows and columns they need
+    if filters == NO_FILTERS:
+        return {name: read_table(path) for name, path in CUBE_PATHS.items()}
+
+    return _filtered_cubes(filters)
+
+
+def similarity_index():
+    ## the float16 matrix stays memory-mapped; only the IVF lists are read into memory
+    return _lookup('similarity_index', EMBEDDINGS_PATH, lambda: load_index(_resolve(EMBEDDINGS_PATH), _resolve(IVF_PATH)))
+
+
+def memory_mb(*frames):
+    return sum(df.memory_usage(deep=True).sum() for df in frames) / 2**20
+
+
+def clear_cache():
+    with _lock:
+        _tables.clear()
+        _lookups.clear()
+
+    for memo in (_filtered_cubes, _filtered_rollup, filtered_percentage_table):
+        memo.clear()
@@ -1,31 +1,104 @@
-import pandas as pd
-import kagglehub
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import os
-import streamlit as st
+
+from memo import memoize
+from pipeline import file_signature
 
 DATASET_NAME = "datafiniti/consumer-reviews-of-amazon-products"
 CSV_FILENAME = "Datafiniti_Amazon_Consumer_Reviews_of_Amazon_Products_May19.csv"
 
-@st.cache_data
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+COLUMN_TYPES = {
+    'id': CATEGORY_TYPE,
+    'name': pa.string(),
+    'brand': CATEGORY_TYPE,
+    'primaryCategories': CATEGORY_TYPE,
+    'reviews.date': pa.string(),
+    'reviews.rating': pa.int8(),
+    'reviews.text': pa.string(),
+    'reviews.title': pa.string(),
+}
+REVIEW_COLUMNS = [column for column in COLUMN_TYPES if column != 'name']
+TEXT_COLUMNS = [column.replace('.', '_') for column, column_type in COLUMN_TYPES.items() if column_type == pa.string() and column != 'name']
+PRODUCT_COLUMNS = ['id', 'name']
+
+## same missing-value markers as pd.read_csv
+NULL_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA',
+               'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+BLOCK_SIZE = 16 << 20
+
+@memoize
 def get_dataset():
     if os.path.exists(CSV_FILENAME):
         return os.path.abspath(CSV_FILENAME)
 
+    import kagglehub
+
     path = kagglehub.dataset_download(DATASET_NAME)
     full_path = os.path.join(path, CSV_FILENAME)
 
     if not os.path.exists(full_path):
         raise FileNotFoundError(f"Dataset not found after download: {full_path}")
-    
+
     return full_path
 
 
-@st.cache_data
-def load_data(path):
-    df = pd.read_csv(path)
-    df = df.drop(['name', 'asins', 'imageURLs', 'keys', 'manufacturer', 'reviews.didPurchase',
-         'reviews.doRecommend', 'reviews.id', 'reviews.numHelpful', 'reviews.sourceURLs',
-         'reviews.username', 'sourceURLs'], axis=1, errors='ignore')
+def csv_options(columns, block_size=BLOCK_SIZE):
+    read_options = pa_csv.ReadOptions(block_size=block_size)
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    convert_options = pa_csv.ConvertOptions(include_columns=columns, column_types={column: COLUMN_TYPES[column] for column in columns},
+                                            null_values=NULL_VALUES, strings_can_be_null=True)
+
+    return read_options, parse_options, convert_options
+
+
+def to_reviews_frame(table):
+    df = table.select(REVIEW_COLUMNS).to_pandas()
     df.columns = df.columns.str.replace('.', '_', regex=False)
+    ## missing strings come back as None; pd.read_csv gave NaN, which the text cleaning turns into 'nan', not 'none'
+    df[TEXT_COLUMNS] = df[TEXT_COLUMNS].where(df[TEXT_COLUMNS].notna(), np.nan)
+
+    return df
+
+
+def to_products_frame(table):
+    return table.select(PRODUCT_COLUMNS).to_pandas().drop_duplicates('id').reset_index(drop=True)
+
+
+## keyed on the file's path, size and mtime rather than on its contents
+@memoize(maxsize=2, copy=True, key=file_signature)
+def load_data_and_products(path):
+    read_options, parse_options, convert_options = csv_options(REVIEW_COLUMNS + ['name'])
+    table = pa_csv.read_csv(path, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+
+    return to_reviews_frame(table), to_products_frame(table)
+
+
+def load_data(path):
+    df, _ = load_data_and_products(path)
+
+    return df
+
+
+def iter_record_batches(path, columns=None, block_size=BLOCK_SIZE):
+    columns = columns or REVIEW_COLUMNS + ['name']
+    read_options, parse_options, convert_options = csv_options(columns, block_size)
+
+    with pa_csv.open_csv(path, read_options=read_options, parse_options=parse_options, convert_options=convert_options) as reader:
+        for batch in reader:
+            yield batch
+
+
+def iter_data(path, block_size=BLOCK_SIZE):
+    ## yields (reviews, new_products) chunks; each product id is emitted once, with the first name seen for it
+    seen_ids = set()
+
+    for batch in iter_record_batches(path, block_size=block_size):
+        table = pa.Table.from_batches([batch])
+        products = to_products_frame(table)
+        products = products[~products['id'].isin(seen_ids)]
+        seen_ids.update(products['id'])
 
-    return df
\ No newline at end of file
+        yield to_reviews_frame(table), products
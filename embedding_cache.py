@@ -0,0 +1,166 @@
+import hashlib
+import os
+import numpy as np
+
+INDEX_FILENAME = 'index.npz'
+VECTORS_FILENAME = 'vectors.f32'
+KEY_SIZE = 16
+INITIAL_CAPACITY = 1024
+
+
+def embedding_key(model_name, normalize, text):
+    payload = f'{model_name}\0{int(bool(normalize))}\0{text}'.encode('utf-8')
+
+    return hashlib.blake2b(payload, digest_size=KEY_SIZE).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path, dim, max_items=2_000_000):
+        self.path = path
+        self.dim = dim
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = os.path.join(path, VECTORS_FILENAME)
+        self.index_path = os.path.join(path, INDEX_FILENAME)
+
+        self.slots = {}
+        self.last_used = np.zeros(0, dtype=np.int64)
+        self.clock = 0
+        self.free_slots = []
+
+        if os.path.exists(self.index_path) and os.path.exists(self.vectors_path):
+            self._load_index()
+        else:
+            self.capacity = 0
+            self.size = 0
+            self.vectors = None
+
+    def _load_index(self):
+        with np.load(self.index_path) as index:
+            if int(index['dim']) != self.dim:
+                raise ValueError(f'Embedding cache at {self.path} has dim {int(index["dim"])}, expected {self.dim}')
+
+            slots = index['slots']
+            self.slots = {key.tobytes(): int(slot) for key, slot in zip(index['keys'], slots)}
+            self.capacity = int(index['capacity'])
+            self.size = int(index['size'])
+            self.clock = int(index['clock'])
+            self.last_used = np.zeros(self.capacity, dtype=np.int64)
+            self.last_used[slots] = index['last_used']
+
+        used = np.zeros(self.capacity, dtype=bool)
+        used[slots] = True
+        self.free_slots = [int(slot) for slot in np.flatnonzero(~used[:self.size])]
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(self.capacity, self.dim))
+
+    def _grow(self, needed):
+        new_capacity = max(self.capacity, INITIAL_CAPACITY)
+        while new_capacity < needed:
+            new_capacity *= 2
+        new_capacity = min(new_capacity, self.max_items)
+        if new_capacity <= self.capacity:
+            return
+
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(new_capacity * self.dim * 4)
+
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(new_capacity, self.dim))
+        last_used = np.zeros(new_capacity, dtype=np.int64)
+        last_used[:self.capacity] = self.last_used
+        self.last_used = last_used
+        self.capacity = new_capacity
+
+    def _evict(self, count, protected):
+        slot_to_key = {slot: key for key, slot in self.slots.items()}
+        candidates = [slot for slot in np.argsort(self.last_used[:self.size], kind='stable') if int(slot) in slot_to_key]
+        evicted = 0
+
+        for slot in candidates:
+            if evicted == count:
+                break
+            key = slot_to_key[int(slot)]
+            if key in protected:
+                continue
+            del self.slots[key]
+            self.free_slots.append(int(slot))
+            evicted += 1
+
+        self.evictions += evicted
+
+    def _allocate(self, count, protected):
+        available = len(self.free_slots) + self.max_items - self.size
+        if count > available:
+            self._evict(count - available, protected)
+
+        allocated = self.free_slots[:count]
+        self.free_slots = self.free_slots[count:]
+
+        remaining = count - len(allocated)
+        if remaining > 0:
+            self._grow(self.size + remaining)
+            allocated.extend(range(self.size, self.size + remaining))
+            self.size += remaining
+
+        return allocated
+
+    def get_many(self, model_name, normalize, texts, encode):
+        if len(texts) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        keys = [embedding_key(model_name, normalize, text) for text in texts]
+        unique_keys = list(dict.fromkeys(keys))
+        if len(unique_keys) > self.max_items:
+            raise ValueError(f'Batch of {len(unique_keys)} distinct texts exceeds the cache size of {self.max_items}')
+
+        first_text = {}
+        for key, text in zip(keys, texts):
+            first_text.setdefault(key, text)
+
+        missing = [key for key in unique_keys if key not in self.slots]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        self.clock += 1
+        if missing:
+            new_vectors = np.asarray(encode([first_text[key] for key in missing]), dtype=np.float32)
+            slots = self._allocate(len(missing), set(unique_keys) - set(missing))
+            self.vectors[slots] = new_vectors
+            for key, slot in zip(missing, slots):
+                self.slots[key] = slot
+
+        rows = np.array([self.slots[key] for key in keys], dtype=np.int64)
+        self.last_used[rows] = self.clock
+
+        return np.array(self.vectors[rows])
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+            'items': len(self.slots),
+            'max_items': self.max_items,
+        }
+
+    def save(self):
+        if self.vectors is None:
+            return
+
+        self.vectors.flush()
+        keys = np.frombuffer(b''.join(self.slots.keys()), dtype=np.uint8).reshape(-1, KEY_SIZE)
+        slots = np.array(list(self.slots.values()), dtype=np.int64)
+
+        tmp_path = self.index_path + '.tmp.npz'
+        np.savez(tmp_path, keys=keys, slots=slots, last_used=self.last_used[slots], dim=self.dim,
+                 capacity=self.capacity, size=self.size, clock=self.clock)
+        os.replace(tmp_path, self.index_path)
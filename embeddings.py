@@ -1,27 +1,166 @@
-from sentence_transformers import SentenceTransformer
-from keybert import KeyBERT
-import streamlit as st
+from sklearn.feature_extraction.text import CountVectorizer
+import numpy as np
+import atexit
+import os
 
-@st.cache_resource
+from embedding_cache import EmbeddingCache
+from memo import memoize
+
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', 'embedding_cache')
+EMBEDDING_CACHE_MAX_ITEMS = 2_000_000
+
+## padded tokens per encode batch: short reviews go in large batches, long ones in small batches
+EMBED_BATCH_TOKENS = 16_384
+## texts are tokenized, sorted and encoded this many at a time, which bounds the extra memory on millions of reviews
+EMBED_CHUNK_SIZE = 100_000
+EMBED_PROCESSES = int(os.environ.get('EMBED_PROCESSES', '1'))
+## smaller encodes (aspect phrases, dashboard queries) run in-process: starting the pool loads the model in every worker
+EMBED_POOL_MIN_TEXTS = 10_000
+EMBED_MAX_SEQ_LENGTH = int(os.environ['EMBED_MAX_SEQ_LENGTH']) if os.environ.get('EMBED_MAX_SEQ_LENGTH') else None
+
+KEYPHRASE_NGRAM_RANGE = (1, 2)
+NR_CANDIDATES = 20
+
+## the models are loaded on first use so importing this module stays cheap
+@memoize
 def load_embed_model():
-    return SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(EMBED_MODEL_NAME)
+
+@memoize
+def load_keybert():
+    from keybert import KeyBERT
+
+    return KeyBERT(load_embed_model())
+
+@memoize
+def load_embedding_cache():
+    dim = load_embed_model().get_sentence_embedding_dimension()
+
+    return EmbeddingCache(EMBEDDING_CACHE_DIR, dim, max_items=EMBEDDING_CACHE_MAX_ITEMS)
+
+_pool = None
+_pool_settings = None
+
+
+def get_embed_pool(model, processes):
+    ## one pool per process, started on first use and kept, so the workers load the model once; the workers copy the
+    ## model when they start, so a different max_seq_length needs a new pool
+    global _pool, _pool_settings
+
+    settings = (processes, model.max_seq_length)
+    if _pool is None or _pool_settings != settings:
+        stop_embed_pool()
+        _pool = model.start_multi_process_pool(['cpu'] * processes)
+        _pool_settings = settings
+
+    return _pool
+
+
+@atexit.register
+def stop_embed_pool():
+    global _pool, _pool_settings
+
+    if _pool is not None:
+        load_embed_model().stop_multi_process_pool(_pool)
+    _pool, _pool_settings = None, None
+
+
+def token_lengths(model, texts):
+    encoded = model.tokenizer(texts, truncation=True, max_length=model.max_seq_length)['input_ids']
+
+    return np.fromiter(map(len, encoded), dtype=np.int64, count=len(texts))
+
+
+def length_buckets(lengths, batch_tokens=EMBED_BATCH_TOKENS):
+    ## longest first, so the first text of each bucket sets its padded length
+    order = np.argsort(-lengths, kind='stable')
+    buckets = []
+    start = 0
+
+    while start < len(order):
+        size = max(batch_tokens // max(int(lengths[order[start]]), 1), 1)
+        buckets.append(order[start:start + size])
+        start += size
+
+    return buckets
+
+
+def encode_chunk(model, chunk, pool=None, normalize_embeddings=False, show_progress_bar=False, batch_tokens=EMBED_BATCH_TOKENS, desc=None):
+    lengths = token_lengths(model, chunk)
+    buckets = length_buckets(lengths, batch_tokens)
+    embeddings = np.empty((len(chunk), model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    if pool is None:
+        if show_progress_bar:
+            from tqdm.auto import tqdm
+            buckets = tqdm(buckets, desc=desc)
 
-@st.cache_resource
-def load_keybert(_model):
-    return KeyBERT(_model)
+        for bucket in buckets:
+            embeddings[bucket] = model.encode([chunk[i] for i in bucket], batch_size=len(bucket),
+                                              normalize_embeddings=normalize_embeddings, show_progress_bar=False)
+    elif len(chunk):
+        ## the pool hands out contiguous slices of the length-sorted chunk, so each worker batches similar lengths
+        order = np.concatenate(buckets)
+        batch_size = max(batch_tokens // max(int(np.median(lengths)), 1), 1)
+        embeddings[order] = model.encode([chunk[i] for i in order], pool=pool, batch_size=batch_size,
+                                         normalize_embeddings=normalize_embeddings, show_progress_bar=show_progress_bar)
 
-embed_model = load_embed_model()
-keybert = load_keybert(embed_model)
+    return embeddings
 
-def get_embeddings(texts):
-    return embed_model.encode(texts, normalize_embeddings=False, show_progress_bar=True)
+
+def iter_embeddings(texts, normalize_embeddings=False, show_progress_bar=False, processes=EMBED_PROCESSES,
+                    max_seq_length=EMBED_MAX_SEQ_LENGTH, chunk_size=EMBED_CHUNK_SIZE, batch_tokens=EMBED_BATCH_TOKENS, use_cache=False):
+    ## yields (offset, embeddings) per chunk, in the input order; with use_cache, each chunk is looked up in the
+    ## embedding cache and only its misses are encoded
+    model = load_embed_model()
+    default_max_seq_length = model.max_seq_length
+    if max_seq_length:
+        model.max_seq_length = max_seq_length
+
+    cache = load_embedding_cache() if use_cache else None
+    if cache is not None:
+        ## a chunk never holds more distinct texts than the cache, so a lookup cannot evict its own entries
+        chunk_size = min(chunk_size, cache.max_items)
+        ## truncated embeddings differ from full-length ones, so they are cached under their own key
+        model_key = EMBED_MODEL_NAME if not max_seq_length else f'{EMBED_MODEL_NAME}@{max_seq_length}'
+
+    pool = get_embed_pool(model, processes) if processes > 1 and len(texts) >= EMBED_POOL_MIN_TEXTS else None
+
+    try:
+        for offset in range(0, len(texts), chunk_size):
+            chunk = list(texts[offset:offset + chunk_size])
+            desc = f'Embedding {offset + len(chunk)}/{len(texts)}'
+
+            def encode(batch):
+                return encode_chunk(model, list(batch), pool, normalize_embeddings, show_progress_bar, batch_tokens, desc)
+
+            yield offset, encode(chunk) if cache is None else cache.get_many(model_key, normalize_embeddings, chunk, encode)
+    finally:
+        model.max_seq_length = default_max_seq_length
+        if cache is not None:
+            cache.save()
+
+
+def get_embeddings(texts, normalize_embeddings=False, show_progress_bar=True, use_cache=True, processes=EMBED_PROCESSES,
+                   max_seq_length=EMBED_MAX_SEQ_LENGTH):
+    embeddings = np.empty((len(texts), load_embed_model().get_sentence_embedding_dimension()), dtype=np.float32)
+
+    for offset, chunk in iter_embeddings(texts, normalize_embeddings=normalize_embeddings, show_progress_bar=show_progress_bar,
+                                         processes=processes, max_seq_length=max_seq_length, use_cache=use_cache):
+        embeddings[offset:offset + len(chunk)] = chunk
+
+    return embeddings
 
 def extract_keywords(text, top_n=3):
-    keywords = keybert.extract_keywords(
+    keywords = load_keybert().extract_keywords(
         text,
-        keyphrase_ngram_range=(1, 2),
+        keyphrase_ngram_range=KEYPHRASE_NGRAM_RANGE,
         stop_words='english',
         use_maxsum=True,
+        nr_candidates=NR_CANDIDATES,
         top_n=top_n
     )
     
@@ -37,4 +176,68 @@ def extract_keywords_by_row(row):
     elif sentiment == 0:
         return extract_keywords(cons)
     else:
-        return extract_keywords(pros) + extract_keywords(cons)
\ No newline at end of file
+        return extract_keywords(pros) + extract_keywords(cons)
+
+def select_keyword_documents(pros, cons, sentiments):
+    documents = []
+
+    for row, (sentiment, pro, con) in enumerate(zip(sentiments, pros, cons)):
+        if sentiment == 2:
+            documents.append((row, pro))
+        elif sentiment == 0:
+            documents.append((row, con))
+        else:
+            documents.append((row, pro))
+            documents.append((row, con))
+
+    return documents
+
+def extract_keywords_batch(pros, cons, sentiments, top_n=3, doc_embeddings=None):
+    ## doc_embeddings, when given, holds one vector per review and replaces the pros/cons document
+    ## embedding KeyBERT would compute, so keywords are ranked against the whole review instead
+    from keybert._maxsum import max_sum_distance
+
+    documents = select_keyword_documents(pros, cons, sentiments)
+    keywords = [[] for _ in range(len(sentiments))]
+
+    texts = list(dict.fromkeys(text for _, text in documents if text))
+    if not texts:
+        return keywords
+
+    try:
+        count = CountVectorizer(ngram_range=KEYPHRASE_NGRAM_RANGE, stop_words='english').fit(texts)
+    except ValueError:
+        return keywords
+
+    words = count.get_feature_names_out()
+    doc_term = count.transform(texts)
+    text_index = {text: i for i, text in enumerate(texts)}
+
+    backend = load_keybert().model
+    word_embeddings = backend.embed(list(words))
+    if doc_embeddings is None:
+        text_embeddings = backend.embed(texts)
+
+    text_keywords = {}
+
+    for row, text in documents:
+        if not text:
+            continue
+
+        i = text_index[text]
+        if doc_embeddings is None and i in text_keywords:
+            keywords[row].extend(text_keywords[i])
+            continue
+
+        candidate_indices = doc_term.indices[doc_term.indptr[i]:doc_term.indptr[i + 1]]
+        candidates = [words[j] for j in candidate_indices]
+        doc_embedding = text_embeddings[i] if doc_embeddings is None else doc_embeddings[row]
+
+        selected = max_sum_distance(doc_embedding.reshape(1, -1), word_embeddings[candidate_indices], candidates, top_n, NR_CANDIDATES)
+        selected = [kb[0] for kb in selected]
+
+        if doc_embeddings is None:
+            text_keywords[i] = selected
+        keywords[row].extend(selected)
+
+    return keywords
@@ -0,0 +1,157 @@
+import glob
+import os
+import shutil
+import pandas as pd
+
+STATE_DIR = 'precompute_state'
+PARTITIONS_DIR = os.path.join(STATE_DIR, 'reviews')
+PHRASE_ASPECTS_PATH = os.path.join(STATE_DIR, 'phrase_to_aspect.parquet')
+COMPLETE_PATH = os.path.join(STATE_DIR, 'complete')
+
+KEY_COLUMNS = ['id', 'reviews_date', 'reviews_title', 'reviews_text']
+CONTENT_COLUMNS = ['id', 'primaryCategories', 'reviews_date', 'reviews_rating', 'reviews_title', 'reviews_text']
+STATE_COLUMNS = ['review_key', 'content_hash', 'id', 'primaryCategories', 'sentiment_label']
+SENTIMENTS = ['Negative', 'Neutral', 'Positive']
+
+
+def add_review_keys(df):
+    ## reviews.id is empty for most Datafiniti rows, so reviews are identified by a hash of their content;
+    ## the occurrence number keeps exact duplicates apart
+    key_hash = pd.util.hash_pandas_object(df[KEY_COLUMNS], index=False)
+    occurrence = key_hash.groupby(key_hash).cumcount()
+    df['review_key'] = pd.util.hash_pandas_object(pd.DataFrame({'key': key_hash, 'occurrence': occurrence}), index=False).values
+    df['content_hash'] = pd.util.hash_pandas_object(df[CONTENT_COLUMNS], index=False).values
+
+    return df
+
+
+def clear_state():
+    if os.path.exists(STATE_DIR):
+        shutil.rmtree(STATE_DIR)
+
+
+def list_partitions():
+    return sorted(glob.glob(os.path.join(PARTITIONS_DIR, 'part-*.parquet')))
+
+
+def empty_state(columns=STATE_COLUMNS):
+    return pd.DataFrame(columns=columns + ['partition'])
+
+
+def load_state(columns=STATE_COLUMNS):
+    frames = []
+    for path in list_partitions():
+        part = pd.read_parquet(path, columns=columns)
+        part['partition'] = path
+        frames.append(part)
+
+    if not frames:
+        return empty_state(columns)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def diff_reviews(df, state):
+    current = pd.MultiIndex.from_arrays([df['review_key'], df['content_hash']])
+    known = pd.MultiIndex.from_arrays([state['review_key'], state['content_hash']])
+
+    changed_rows = df[~current.isin(known)]
+    stale = state[~known.isin(current)]
+
+    return changed_rows, stale
+
+
+## written next to the target and renamed over it, so a partition is never left half written
+def write_parquet(df, path):
+    tmp_path = f'{path}.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def remove_reviews(stale):
+    for path, keys in stale.groupby('partition')['review_key']:
+        part = pd.read_parquet(path)
+        part = part[~part['review_key'].isin(keys)]
+
+        if part.empty:
+            os.remove(path)
+        else:
+            write_parquet(part, path)
+
+
+def write_partition(processed):
+    if processed.empty:
+        return None
+
+    os.makedirs(PARTITIONS_DIR, exist_ok=True)
+    partitions = list_partitions()
+    next_number = int(os.path.basename(partitions[-1])[5:10]) + 1 if partitions else 0
+    path = os.path.join(PARTITIONS_DIR, f'part-{next_number:05d}.parquet')
+    write_parquet(processed, path)
+
+    return path
+
+
+def load_reviews(review_keys, pending=None, saved=True):
+    frames = [pd.read_parquet(path) for path in list_partitions()] if saved else []
+    if pending is not None:
+        ## reviews not written yet replace their saved versions
+        frames = [part[~part['review_key'].isin(pending['review_key'])] for part in frames] + [pending]
+
+    reviews = pd.concat(frames, ignore_index=True)
+    reviews = reviews.set_index('review_key').loc[review_keys].reset_index()
+    reviews['sentiment_label'] = pd.Categorical(reviews['sentiment_label'].astype(str), categories=SENTIMENTS)
+
+    return reviews
+
+
+def load_phrase_to_aspect():
+    if not os.path.exists(PHRASE_ASPECTS_PATH):
+        return None
+
+    phrase_aspects = pd.read_parquet(PHRASE_ASPECTS_PATH)
+
+    return dict(zip(phrase_aspects['phrase'], phrase_aspects['aspect']))
+
+
+def save_phrase_to_aspect(phrase_to_aspect):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    phrase_aspects = pd.DataFrame({'phrase': list(phrase_to_aspect.keys()), 'aspect': list(phrase_to_aspect.values())})
+    phrase_aspects.to_parquet(PHRASE_ASPECTS_PATH, index=False)
+
+
+## set once the saved state and the count tables built from it agree; a run that stops in between leaves it unset
+def state_complete():
+    return os.path.exists(COMPLETE_PATH)
+
+
+def clear_complete():
+    if os.path.exists(COMPLETE_PATH):
+        os.remove(COMPLETE_PATH)
+
+
+def mark_complete():
+    os.makedirs(STATE_DIR, exist_ok=True)
+    open(COMPLETE_PATH, 'w').close()
+
+
+def sentiment_counts(df, by):
+    keys = df[by].astype(object)
+    counts = df.groupby([keys, 'sentiment_label'], observed=False).size().unstack('sentiment_label', fill_value=0)
+
+    return counts.reindex(columns=SENTIMENTS, fill_value=0).astype(float)
+
+
+def apply_count_delta(table, added, removed, by):
+    if table is None:
+        counts = pd.DataFrame(columns=SENTIMENTS, dtype=float)
+    else:
+        counts = table.set_index(by)[SENTIMENTS]
+
+    delta = sentiment_counts(added, by).sub(sentiment_counts(removed, by), fill_value=0)
+    counts = counts.add(delta, fill_value=0)
+    counts = counts[counts.sum(axis=1) > 0].sort_index()
+    counts.index.name = by
+    counts.columns.name = 'sentiment_label'
+
+    return counts.reset_index()
@@ -0,0 +1,145 @@
+import contextvars
+import functools
+import json
+import mmap
+import os
+import threading
+import time
+from collections import Counter
+
+## Unix only; without it (on Windows) the events carry no memory figures
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## PERF_INSTRUMENTATION=1 records every run; otherwise only runs started with enabled=True (the dashboard's ?perf=1) record
+ENABLED = os.environ.get('PERF_INSTRUMENTATION', '0') == '1'
+PERF_LOG_PATH = os.environ.get('PERF_LOG', 'perf_log.jsonl')
+PAGE_MB = mmap.PAGESIZE / 2**20
+
+_current = contextvars.ContextVar('perf_run', default=None)
+_log_lock = threading.Lock()
+
+
+class _NullTimer:
+    ## shared no-op returned when nothing is recording, so a disabled hook costs one context variable lookup
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_MB
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None
+
+
+class Run:
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.events = []
+        self.counters = Counter()
+        self.seconds = None
+
+    def summary(self):
+        return {'run': self.label, 'started': self.started, 'seconds': self.seconds, 'events': self.events, 'counters': dict(self.counters)}
+
+
+class _Timer:
+    def __init__(self, run, name, kind):
+        self.run = run
+        self.event = {'name': name, 'kind': kind}
+
+    def __enter__(self):
+        self.rss = rss_mb()
+        self.started = time.perf_counter()
+
+        return self.event
+
+    def __exit__(self, exc_type, *exc):
+        self.event['ms'] = round((time.perf_counter() - self.started) * 1000, 3)
+        if self.rss is not None:
+            self.event['rss_delta_mb'] = round(rss_mb() - self.rss, 2)
+        if exc_type is not None:
+            self.event['error'] = exc_type.__name__
+        self.run.events.append(self.event)
+
+        return False
+
+
+def timed(name, kind='block'):
+    ## with timed('load data', 'load') as event: ... -- event is None when nothing is recording, else a dict for extra fields
+    run = _current.get()
+
+    return _NULL_TIMER if run is None else _Timer(run, name, kind)
+
+
+def instrument(kind='function', name=None):
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            run = _current.get()
+            if run is None:
+                return func(*args, **kwargs)
+
+            run.counters[f'{label} calls'] += 1
+            with _Timer(run, label, kind):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def cache_miss(func):
+    ## goes under a caching decorator: the body only runs on a miss, so calls minus misses are the hits
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        count(f'{func.__name__} cache misses')
+
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def count(name, n=1):
+    run = _current.get()
+    if run is not None:
+        run.counters[name] += n
+
+
+def start_run(label, enabled=None):
+    ## returns the Run, or None when this run is not recorded
+    if not (ENABLED if enabled is None else enabled):
+        return None
+
+    run = Run(label)
+    run.token = _current.set(run)
+    run.perf_started = time.perf_counter()
+
+    return run
+
+
+def finish_run(run, log_path=None):
+    if run is None:
+        return None
+
+    run.seconds = round(time.perf_counter() - run.perf_started, 4)
+    _current.reset(run.token)
+
+    ## one JSON line per run
+    with _log_lock, open(log_path or PERF_LOG_PATH, 'a') as f:
+        f.write(json.dumps(run.summary()) + '\n')
+
+    return run.summary()
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+import os
+import pandas as pd
+
+
+class LemmaCache:
+    ## phrase -> normalized lemmas, least recently used first; an empty lemma means the phrase normalizes to nothing
+    def __init__(self, path, model_name, max_items=500_000):
+        self.path = path
+        self.model_name = model_name
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lemmas = OrderedDict()
+
+        if os.path.exists(path):
+            stored = pd.read_parquet(path)
+            ## lemmas from another spaCy model are not reused
+            if len(stored) and (stored['model'] == model_name).all():
+                self.lemmas.update(zip(stored['phrase'], stored['lemma']))
+
+    def get_many(self, phrases, lemmatize):
+        unique_phrases = list(dict.fromkeys(phrases))
+        missing = [phrase for phrase in unique_phrases if phrase not in self.lemmas]
+        self.hits += len(unique_phrases) - len(missing)
+        self.misses += len(missing)
+
+        for phrase in unique_phrases:
+            if phrase in self.lemmas:
+                self.lemmas.move_to_end(phrase)
+
+        found = dict(zip(missing, lemmatize(missing))) if missing else {}
+        self.lemmas.update(found)
+        ## built before evicting: a call with more phrases than max_items can evict its own hits
+        lemmas = [self.lemmas[phrase] for phrase in phrases]
+
+        while len(self.lemmas) > self.max_items:
+            self.lemmas.popitem(last=False)
+            self.evictions += 1
+
+        return lemmas
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+            'items': len(self.lemmas),
+            'max_items': self.max_items,
+        }
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        stored = pd.DataFrame({'phrase': list(self.lemmas.keys()), 'lemma': list(self.lemmas.values())})
+        stored['model'] = self.model_name
+
+        tmp_path = self.path + '.tmp'
+        stored.to_parquet(tmp_path, index=False, compression='zstd')
+        os.replace(tmp_path, self.path)
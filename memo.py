@@ -0,0 +1,189 @@
+import copy
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from instrumentation import count
+
+MEMO_DIR = os.environ.get('MEMO_CACHE_DIR', 'memo_cache')
+## MEMO_DISK=0 keeps every memoized call in memory only
+MEMO_DISK = os.environ.get('MEMO_DISK', '1') != '0'
+KEY_SIZE = 16
+
+_memos = []
+
+
+def _update(digest, value):
+    ## arrays and frames are hashed from their buffers, so a fingerprint costs one pass over the data and no pickling
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        digest.update(f'{type(value).__name__}:{value!r};'.encode('utf-8'))
+    elif isinstance(value, np.ndarray):
+        digest.update(f'ndarray:{value.dtype.str}:{value.shape};'.encode('utf-8'))
+        if value.dtype == object:
+            value = pd.util.hash_array(value.ravel())
+        digest.update(np.ascontiguousarray(value))
+    elif isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        header = list(zip(map(str, value.columns), map(str, value.dtypes))) if isinstance(value, pd.DataFrame) else str(value.dtype)
+        digest.update(f'{type(value).__name__}:{header}:{len(value)};'.encode('utf-8'))
+        digest.update(np.ascontiguousarray(pd.util.hash_pandas_object(value, index=not isinstance(value, pd.Index)).to_numpy()))
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}:{len(value)};'.encode('utf-8'))
+        for item in value:
+            _update(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f'dict:{len(value)};'.encode('utf-8'))
+        for item_key in sorted(value, key=repr):
+            _update(digest, item_key)
+            _update(digest, value[item_key])
+    elif isinstance(value, (set, frozenset)):
+        digest.update(f'set:{sorted(fingerprint(item) for item in value)};'.encode('utf-8'))
+    else:
+        raise TypeError(f'Cannot fingerprint {type(value).__name__}; pass key= to memoize to say what identifies the call')
+
+
+def fingerprint(*values):
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    for value in values:
+        _update(digest, value)
+
+    return digest.hexdigest()
+
+
+def code_fingerprint(func):
+    ## results on disk are dropped when the function's source changes
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = repr(func.__code__.co_code)
+
+    return fingerprint(func.__module__, func.__qualname__, source)
+
+
+class Memo:
+    def __init__(self, func, maxsize=128, disk=False, key=None, copy=False, directory=None):
+        self.func = func
+        self.maxsize = maxsize
+        self.disk = disk
+        self.key = key
+        self.copy = copy
+        self.directory = directory or os.path.join(MEMO_DIR, f'{func.__module__}.{func.__qualname__}')
+        self.signature = inspect.signature(func)
+        self.version = code_fingerprint(func) if disk else None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        functools.update_wrapper(self, func)
+        _memos.append(self)
+
+    def cache_key(self, args, kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+
+        if self.key is not None:
+            return fingerprint(self.key(*bound.args, **bound.kwargs))
+
+        return fingerprint(dict(bound.arguments))
+
+    def _path(self, cache_key):
+        return os.path.join(self.directory, f'{self.version}-{cache_key}.pkl')
+
+    def _read_disk(self, cache_key):
+        path = self._path(cache_key)
+        if not (self.disk and MEMO_DISK and os.path.exists(path)):
+            return False, None
+
+        try:
+            with open(path, 'rb') as f:
+                return True, pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def _write_disk(self, cache_key, value):
+        if not (self.disk and MEMO_DISK):
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(cache_key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _remember(self, cache_key, value):
+        with self.lock:
+            self.entries[cache_key] = value
+            self.entries.move_to_end(cache_key)
+            while self.maxsize is not None and len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def _result(self, value):
+        ## callers get their own copy when they may mutate the result, like st.cache_data does
+        return copy.deepcopy(value) if self.copy else value
+
+    def __call__(self, *args, **kwargs):
+        cache_key = self.cache_key(args, kwargs)
+
+        with self.lock:
+            found = cache_key in self.entries
+            if found:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                value = self.entries[cache_key]
+        if found:
+            count(f'{self.func.__name__} memo hits')
+            return self._result(value)
+
+        found, value = self._read_disk(cache_key)
+        if found:
+            count(f'{self.func.__name__} memo disk hits')
+            with self.lock:
+                self.disk_hits += 1
+        else:
+            count(f'{self.func.__name__} memo misses')
+            value = self.func(*args, **kwargs)
+            with self.lock:
+                self.misses += 1
+            self._write_disk(cache_key, value)
+
+        self._remember(cache_key, value)
+
+        return self._result(value)
+
+    def clear(self, disk=False):
+        with self.lock:
+            self.entries.clear()
+
+        if disk and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def cache_info(self):
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'items': len(self.entries), 'maxsize': self.maxsize}
+
+
+def memoize(func=None, maxsize=128, disk=False, key=None, copy=False):
+    ## @memoize on a zero-argument loader keeps one shared instance, like st.cache_resource
+    ## key= receives the call's arguments and returns what identifies it, e.g. a path's size and mtime instead of the file contents
+    if func is None:
+        return lambda func: Memo(func, maxsize=maxsize, disk=disk, key=key, copy=copy)
+
+    return Memo(func, maxsize=maxsize, disk=disk, key=key, copy=copy)
+
+
+def memo_stats():
+    return {f'{memo.func.__module__}.{memo.func.__qualname__}': memo.cache_info() for memo in _memos}
+
+
+def clear_memos(disk=False):
+    for memo in _memos:
+        memo.clear(disk=disk)
@@ -0,0 +1,236 @@
+import hashlib
+import inspect
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+
+## Unix only; without it (on Windows) the stage report has no peak memory
+try:
+    import resource
+except ImportError:
+    resource = None
+
+CODE_VERSION = 1
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    ## a directory output (a partitioned dataset) hashes as its files' relative paths and contents
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode())
+                digest.update(hash_file(file_path).encode())
+
+        return digest.hexdigest()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_signature(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def reset_peak_memory():
+    ## Linux only: resets VmHWM so the next reading is the peak of the current stage
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None
+
+
+class Stage:
+    def __init__(self, name, func, requires, sources, params, when, helpers=()):
+        self.name = name
+        self.func = func
+        self.requires = requires
+        self.sources = sources
+        self.helpers = helpers
+        self.params = params
+        self.when = when
+
+    def code_version(self):
+        digest = hashlib.sha256(f'{CODE_VERSION}'.encode())
+        digest.update(inspect.getsource(self.func).encode())
+        for source in self.sources:
+            digest.update(hash_file(source).encode())
+        ## helpers from the stage's own module: functions hash by their source, constants by their value
+        for helper in self.helpers:
+            digest.update((inspect.getsource(helper) if callable(helper) else repr(helper)).encode())
+
+        return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, checkpoint_dir, base_dir='.'):
+        self.checkpoint_dir = checkpoint_dir
+        self.base_dir = base_dir
+        self.stages = []
+
+    def stage(self, name, requires=(), sources=(), params=None, when=None, helpers=()):
+        def decorator(func):
+            stage_sources = [os.path.join(self.base_dir, source) for source in sources]
+            self.stages.append(Stage(name, func, list(requires), stage_sources, params, when, list(helpers)))
+            return func
+
+        return decorator
+
+    def stage_names(self):
+        return [stage.name for stage in self.stages]
+
+    def _meta_path(self, name):
+        return os.path.join(self.checkpoint_dir, f'{name}.json')
+
+    def _read_meta(self, name):
+        path = self._meta_path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _fingerprint(self, stage, context, metas):
+        payload = {
+            'stage': stage.name,
+            'code': stage.code_version(),
+            'params': stage.params(context) if stage.params else None,
+            'upstream': {name: metas[name]['output_hash'] for name in stage.requires if name in metas},
+        }
+
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _is_valid(self, meta, fingerprint):
+        if meta is None or meta['fingerprint'] != fingerprint:
+            return False
+
+        return all(os.path.exists(artifact['path']) for artifact in meta['artifacts'].values())
+
+    def _save(self, stage, fingerprint, outputs):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        artifacts = {}
+
+        for name, value in outputs.items():
+            if isinstance(value, pd.DataFrame):
+                path = os.path.join(self.checkpoint_dir, f'{stage.name}.{name}.parquet')
+                value.to_parquet(path)
+                artifacts[name] = {'type': 'parquet', 'path': path}
+            elif isinstance(value, np.ndarray):
+                path = os.path.join(self.checkpoint_dir, f'{stage.name}.{name}.npy')
+                np.save(path, value)
+                artifacts[name] = {'type': 'npy', 'path': path}
+            elif isinstance(value, str):
+                artifacts[name] = {'type': 'file', 'path': value}
+            else:
+                raise TypeError(f'Stage {stage.name} returned an unsupported artifact {name!r}: {type(value).__name__}')
+
+        digest = hashlib.sha256()
+        for name in sorted(artifacts):
+            digest.update(name.encode())
+            digest.update(hash_file(artifacts[name]['path']).encode())
+
+        meta = {'stage': stage.name, 'fingerprint': fingerprint, 'output_hash': digest.hexdigest(), 'artifacts': artifacts}
+        tmp_path = self._meta_path(stage.name) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, self._meta_path(stage.name))
+
+        return meta
+
+    def _load(self, meta):
+        outputs = {}
+        for name, artifact in meta['artifacts'].items():
+            if artifact['type'] == 'parquet':
+                outputs[name] = pd.read_parquet(artifact['path'])
+            elif artifact['type'] == 'npy':
+                outputs[name] = np.load(artifact['path'], mmap_mode='r')
+            else:
+                outputs[name] = artifact['path']
+
+        return outputs
+
+    def run(self, context, force=(), start=None):
+        names = self.stage_names()
+        for name in list(force) + ([start] if start else []):
+            if name not in names:
+                raise ValueError(f'Unknown stage {name!r}, expected one of {names}')
+
+        forced = set(force)
+        if start:
+            forced.update(names[names.index(start):])
+
+        metas = {}
+        outputs = {}
+        report = []
+
+        for stage in self.stages:
+            if stage.when and not stage.when(context):
+                report.append((stage.name, 'skipped', 0.0, 0.0))
+                continue
+
+            fingerprint = self._fingerprint(stage, context, metas)
+            meta = self._read_meta(stage.name)
+
+            if stage.name not in forced and self._is_valid(meta, fingerprint):
+                metas[stage.name] = meta
+                report.append((stage.name, 'cached', 0.0, 0.0))
+                continue
+
+            inputs = {}
+            for name in stage.requires:
+                if name not in outputs:
+                    outputs[name] = self._load(metas[name])
+                clashes = inputs.keys() & outputs[name].keys()
+                if clashes:
+                    raise ValueError(f'Stage {stage.name} gets {sorted(clashes)} from more than one of the stages it requires')
+                inputs.update(outputs[name])
+
+            reset_peak_memory()
+            started = time.perf_counter()
+            with timed(stage.name, 'stage'):
+                result = stage.func(context, **inputs) or {}
+            elapsed = time.perf_counter() - started
+
+            metas[stage.name] = self._save(stage, fingerprint, result)
+            outputs[stage.name] = result
+            report.append((stage.name, 'ran', elapsed, peak_memory_mb()))
+            print(f'Stage {stage.name} finished in {elapsed:.1f}s')
+
+        print_report(report)
+
+        return report
+
+
+def print_report(report):
+    print(f"{'stage':<12}{'status':<10}{'wall time':>12}{'peak memory':>14}")
+    for name, status, elapsed, peak in report:
+        if status == 'ran':
+            memory = '-' if peak is None else f'{peak:.0f} MB'
+            print(f'{name:<12}{status:<10}{elapsed:>11.1f}s{memory:>14}')
+        else:
+            print(f'{name:<12}{status:<10}{"-":>12}{"-":>14}')
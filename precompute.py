@@ -1,90 +1,276 @@
 from itertools import chain
 from sklearn.model_selection import train_test_split
 import pandas as pd
+import argparse
+import os
 
-from data_loader import load_data, get_dataset
-from preprocessing import clean_text, rating_to_sentiment, map_sentiment_labels, calc_pos_neg_percentage
+from data_loader import load_data_and_products, get_dataset
+from preprocessing import clean_text_series, ratings_to_sentiment, map_sentiment_labels, add_percentage_columns
 from pros_cons import process_pros_cons
-from embeddings import get_embeddings, extract_keywords, extract_keywords_by_row
-from aspects import normalize_phrases, cluster_aspects, map_to_aspects
-from sentiment_model import build_nn, train_nn_model
+from embeddings import get_embeddings, extract_keywords_batch, load_embedding_cache, stop_embed_pool
+from aspects import (normalize_phrase_lists, fit_aspect_centroids, save_aspect_centroids, load_aspect_centroids, assign_aspects, map_to_aspects,
+                     load_lemma_cache, ASPECT_CENTROIDS_PATH)
+from sentiment_inference import WEIGHTS_PATH
+from incremental import (add_review_keys, clear_state, empty_state, load_state, diff_reviews, remove_reviews, write_partition,
+                         load_reviews, list_partitions, load_phrase_to_aspect, save_phrase_to_aspect, apply_count_delta,
+                         state_complete, clear_complete, mark_complete,
+                         PHRASE_ASPECTS_PATH, SENTIMENTS)
+from aggregates import add_date_dimension, write_cubes, CUBE_PATHS
+from review_store import write_review_tables, review_order, REVIEWS_PATH, REVIEW_ASPECTS_PATH
+from similarity_index import build_index, save_review_texts, EMBEDDINGS_PATH, IVF_PATH, TEXTS_PATH
+from pipeline import Pipeline, file_signature
+from shards import run_sharded, shutdown_pool, NLP_WORKERS
+from instrumentation import start_run, finish_run
 
-path = get_dataset()
-df = load_data(path)
+MODEL_PATH = 'sentiment_model.h5'
+CATEGORIES_COUNT_PATH = 'processed_reviews_categories_count.parquet'
+PRODUCTS_COUNT_PATH = 'processed_reviews_products_count.parquet'
+CHECKPOINT_DIR = 'checkpoints'
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-df['sentiment'] = df['reviews_rating'].apply(rating_to_sentiment)
-df['reviews_text_clean'] = df['reviews_text'].apply(clean_text)
-df['text_for_model'] = df['reviews_title'].fillna('') + ' ' + df['reviews_text_clean']
+PARTITION_COLUMNS = ['review_key', 'content_hash', 'id', 'primaryCategories', 'reviews_date', 'reviews_rating', 'sentiment_label', 'aspects']
 
-embeddings = get_embeddings(df['text_for_model'].to_list())
+pipeline = Pipeline(CHECKPOINT_DIR, base_dir=BASE_DIR)
 
-X_train, X_test, y_train, y_test = train_test_split(embeddings, df['sentiment'], test_size=0.2, random_state=123)
 
-model_nn = build_nn(embeddings.shape[1])
-model_nn = train_nn_model(model_nn, X_train, y_train)
+def is_full_run(context):
+    return not context['incremental']
 
-model_nn.save("sentiment_model.h5")
 
-loss, acc = model_nn.evaluate(X_test, y_test)
+def state_signature(context):
+    if not context['incremental']:
+        return {'incremental': False}
 
-print(f"Test Accuracy: {acc:.4f}")
+    return {
+        'incremental': True,
+        'partitions': [file_signature(path) for path in list_partitions()],
+        'phrase_to_aspect': file_signature(PHRASE_ASPECTS_PATH),
+        'aspect_centroids': file_signature(ASPECT_CENTROIDS_PATH),
+    }
 
-df = process_pros_cons(df)
 
-df = map_sentiment_labels(df)
+def model_texts(df, clean_texts=None):
+    clean_texts = clean_text_series(df['reviews_text']) if clean_texts is None else clean_texts
 
-df['key_phrases'] = df.apply(extract_keywords_by_row, axis=1)
+    return df['reviews_title'].fillna('') + ' ' + clean_texts
 
-df['normalized_phrases'] = df['key_phrases'].apply(normalize_phrases)
 
-all_phrases = list(chain.from_iterable(df['normalized_phrases']))
+def prepare_text(df):
+    df['sentiment'] = ratings_to_sentiment(df['reviews_rating'])
+    df['reviews_text_clean'] = clean_text_series(df['reviews_text'])
+    df['text_for_model'] = model_texts(df, df['reviews_text_clean'])
 
-phrase_to_aspect = cluster_aspects(all_phrases)
+    return map_sentiment_labels(df)
 
-df['aspects'] = df['normalized_phrases'].apply(lambda x: map_to_aspects(phrase_to_aspect, x))
 
-sentiment_labels = {0: 'Negative', 1: 'Neutral', 2: 'Positive'}
-df['sentiment_label'] = df['sentiment'].map(sentiment_labels)
+def update_count_table(path, by, added, removed, rebuild):
+    table = None if rebuild else pd.read_parquet(path)
+    counts = apply_count_delta(table, added, removed, by)
+    counts = add_percentage_columns(counts)
+    counts.to_parquet(path)
 
-df.drop(['categories', 'brand', 'dateAdded', 'dateUpdated', 'manufacturerNumber', 'reviews_dateSeen', 'reviews_text', 'reviews_title', 'sentiment', 'text_for_model', 'pros', 'cons', 'reviews_text_clean', 'final_pros', 'final_cons', 'key_phrases', 'normalized_phrases'], axis=1, inplace=True)
 
-df = df.explode('aspects')
+@pipeline.stage('load', sources=['data_loader.py', 'incremental.py'],
+                params=lambda context: file_signature(context['dataset_path']))
+def load_stage(context):
+    reviews, products = load_data_and_products(context['dataset_path'])
+    reviews = add_review_keys(reviews)
 
-df['sentiment_label'] = df['sentiment_label'].astype(str).str.strip()
-df['sentiment_label'] = pd.Categorical(df['sentiment_label'], categories=['Negative','Neutral','Positive'])
-df['reviews_date'] = pd.to_datetime(df['reviews_date'], format='ISO8601', utc=True, errors='coerce')
+    return {'reviews': reviews, 'products': products}
 
-df.to_parquet("processed_reviews.parquet")
 
-print('DONE! Saved processed_reviews.parquet and sentiment_model.h5')
+@pipeline.stage('clean', requires=['load'], sources=['preprocessing.py', 'incremental.py'], params=state_signature,
+                helpers=[prepare_text, model_texts])
+def clean_stage(context, reviews, products):
+    state = load_state() if context['incremental'] else empty_state()
+    changed, stale = diff_reviews(reviews, state)
+    print(f'{len(changed)} new or changed reviews, {len(stale)} stale reviews')
 
-df = df.drop('aspects', axis=1)
-df.drop_duplicates(inplace=True)
-original_df = pd.read_csv(path)
-original_df = original_df[['id', 'name']]
-df = df.merge(original_df, on='id', how='left')
+    changed = prepare_text(changed.reset_index(drop=True))
 
-df_categories = df.groupby(['primaryCategories', 'sentiment_label']).size().reset_index(name='count')
-df_products = df.groupby(['name', 'sentiment_label']).size().reset_index(name='count')
+    return {'changed': changed, 'stale': stale}
 
-df_categories = df_categories.pivot_table(index='primaryCategories', columns='sentiment_label', values='count', fill_value=0).reset_index()
-df_products = df_products.pivot_table(index='name', columns='sentiment_label', values='count', fill_value=0).reset_index()
 
-df_categories['Pos/Neg Percentage'] = df_categories.apply(lambda row: calc_pos_neg_percentage(row, 'Positive', 'Negative'), axis=1)
-df_categories['Pos/Neu Percentage'] = df_categories.apply(lambda row: calc_pos_neg_percentage(row, 'Positive', 'Neutral'), axis=1)
-df_categories['Neg/Neu Percentage'] = df_categories.apply(lambda row: calc_pos_neg_percentage(row, 'Negative', 'Neutral'), axis=1)
-df_categories['Pos/All Percentage'] = df_categories.apply(lambda row: calc_pos_neg_percentage(row, 'Positive'), axis=1)
-df_categories['Neg/All Percentage'] = df_categories.apply(lambda row: calc_pos_neg_percentage(row, 'Negative'), axis=1)
+@pipeline.stage('embed', requires=['clean'], sources=['embeddings.py', 'embedding_cache.py'], when=is_full_run)
+def embed_stage(context, changed, stale):
+    embeddings = get_embeddings(changed['text_for_model'].to_list())
+    print(f"Embedding cache: {load_embedding_cache().stats()}")
 
+    return {'embeddings': embeddings}
 
-df_products['Pos/Neg Percentage'] = df_products.apply(lambda row: calc_pos_neg_percentage(row, 'Positive', 'Negative'), axis=1)
-df_products['Pos/Neu Percentage'] = df_products.apply(lambda row: calc_pos_neg_percentage(row, 'Positive', 'Neutral'), axis=1)
-df_products['Neg/Neu Percentage'] = df_products.apply(lambda row: calc_pos_neg_percentage(row, 'Negative', 'Neutral'), axis=1)
-df_products['Pos/All Percentage'] = df_products.apply(lambda row: calc_pos_neg_percentage(row, 'Positive'), axis=1)
-df_products['Neg/All Percentage'] = df_categories.apply(lambda row: calc_pos_neg_percentage(row, 'Negative'), axis=1)
 
+@pipeline.stage('train', requires=['clean', 'embed'], sources=['sentiment_model.py', 'sentiment_inference.py'], when=is_full_run,
+                helpers=[MODEL_PATH])
+def train_stage(context, changed, stale, embeddings):
+    ## TensorFlow is imported here only, so the NLP worker processes, which re-import this module, do not load it
+    from sentiment_model import build_nn, train_nn_model, export_model_weights
 
-df_categories.to_parquet('processed_reviews_categories_count.parquet')
-df_products.to_parquet('processed_reviews_products_count.parquet')
+    X_train, X_test, y_train, y_test = train_test_split(embeddings, changed['sentiment'], test_size=0.2, random_state=123)
 
-print('DONE! Saved processed_reviews_categories_count.parquet and processed_reviews_products_count.parquet')
\ No newline at end of file
+    model_nn = build_nn(embeddings.shape[1])
+    model_nn = train_nn_model(model_nn, X_train, y_train)
+
+    model_nn.save(MODEL_PATH)
+    export_model_weights(model_nn, WEIGHTS_PATH)
+
+    loss, acc = model_nn.evaluate(X_test, y_test)
+
+    print(f"Test Accuracy: {acc:.4f}")
+
+    return {'model': MODEL_PATH, 'weights': WEIGHTS_PATH}
+
+
+@pipeline.stage('pros_cons', requires=['clean'], sources=['pros_cons.py'])
+def pros_cons_stage(context, changed, stale):
+    pros_cons = process_pros_cons(changed[['reviews_text_clean', 'sentiment']].copy(), workers=context['workers'])
+
+    return {'pros_cons': pros_cons[['pros', 'cons', 'final_pros', 'final_cons']]}
+
+
+@pipeline.stage('keywords', requires=['clean', 'pros_cons'], sources=['embeddings.py'])
+def keywords_stage(context, changed, stale, pros_cons):
+    key_phrases = run_sharded(extract_keywords_batch, pros_cons['pros'].to_list(), pros_cons['cons'].to_list(), changed['sentiment'].to_list(),
+                              workers=context['workers'])
+
+    return {'key_phrases': pd.DataFrame({'key_phrases': key_phrases})}
+
+
+@pipeline.stage('normalize', requires=['keywords'], sources=['aspects.py', 'lemma_cache.py'])
+def normalize_stage(context, key_phrases):
+    normalized_phrases = normalize_phrase_lists(key_phrases['key_phrases'], workers=context['workers'])
+    print(f"Lemma cache: {load_lemma_cache().stats()}")
+
+    return {'normalized_phrases': pd.DataFrame({'normalized_phrases': normalized_phrases})}
+
+
+@pipeline.stage('cluster', requires=['normalize'], sources=['aspects.py', 'embeddings.py'], params=state_signature)
+def cluster_stage(context, normalized_phrases):
+    all_phrases = list(chain.from_iterable(normalized_phrases['normalized_phrases']))
+    phrase_to_aspect = load_phrase_to_aspect() if context['incremental'] else None
+    aspect_model = load_aspect_centroids()
+
+    if phrase_to_aspect is None:
+        aspect_model, phrase_to_aspect = fit_aspect_centroids(all_phrases, previous=aspect_model)
+        save_aspect_centroids(aspect_model)
+    elif aspect_model is not None:
+        ## new phrases go to the nearest saved centroid instead of re-clustering
+        unseen = [phrase for phrase in dict.fromkeys(all_phrases) if phrase not in phrase_to_aspect]
+        phrase_to_aspect.update(assign_aspects(unseen, aspect_model))
+        print(f'Assigned {len(unseen)} new phrases to the saved aspect centroids')
+
+    return {'phrase_to_aspect': pd.DataFrame({'phrase': list(phrase_to_aspect.keys()), 'aspect': list(phrase_to_aspect.values())})}
+
+
+@pipeline.stage('aggregate', requires=['load', 'clean', 'normalize', 'cluster'],
+                sources=['incremental.py', 'preprocessing.py', 'aggregates.py', 'review_store.py'], params=state_signature,
+                helpers=[update_count_table, PARTITION_COLUMNS, CATEGORIES_COUNT_PATH, PRODUCTS_COUNT_PATH])
+def aggregate_stage(context, reviews, products, changed, stale, normalized_phrases, phrase_to_aspect):
+    phrase_to_aspect = dict(zip(phrase_to_aspect['phrase'], phrase_to_aspect['aspect']))
+    incremental = context['incremental']
+
+    processed = changed.copy()
+    processed['aspects'] = normalized_phrases['normalized_phrases'].apply(lambda x: map_to_aspects(phrase_to_aspect, x))
+    processed['sentiment_label'] = processed['sentiment_label'].astype(str).str.strip()
+    processed['sentiment_label'] = pd.Categorical(processed['sentiment_label'], categories=SENTIMENTS)
+    processed['reviews_date'] = pd.to_datetime(processed['reviews_date'], format='ISO8601', utc=True, errors='coerce')
+    processed = processed[PARTITION_COLUMNS]
+
+    rebuild = (not incremental or not list_partitions() or not state_complete()
+               or not (os.path.exists(CATEGORIES_COUNT_PATH) and os.path.exists(PRODUCTS_COUNT_PATH)))
+
+    ## the output tables are written before the state, so a failure part way through leaves the state unchanged
+    ## or, once it has started changing, unmarked, and the next run rebuilds the counts from it
+    clear_complete()
+    current = load_reviews(reviews['review_key'], pending=processed, saved=incremental)
+
+    exported = add_date_dimension(current.drop(['review_key', 'content_hash'], axis=1))
+    write_review_tables(exported)
+
+    print(f'DONE! Saved {REVIEWS_PATH} and {REVIEW_ASPECTS_PATH}')
+
+    write_cubes(exported)
+
+    print(f"DONE! Saved {', '.join(CUBE_PATHS.values())}")
+
+    if rebuild:
+        added, removed = current, empty_state()
+    else:
+        added, removed = processed, stale
+
+    added = added.merge(products, on='id', how='left')
+    removed = removed.merge(products, on='id', how='left')
+
+    update_count_table(CATEGORIES_COUNT_PATH, 'primaryCategories', added, removed, rebuild)
+    update_count_table(PRODUCTS_COUNT_PATH, 'name', added, removed, rebuild)
+
+    print(f'DONE! Saved {CATEGORIES_COUNT_PATH} and {PRODUCTS_COUNT_PATH}')
+
+    if not incremental:
+        clear_state()
+    ## stale reviews go first: a run stopped before the new partition is written finds the changed reviews again,
+    ## whereas the other order would leave two versions of them in the state
+    remove_reviews(stale)
+    write_partition(processed)
+    save_phrase_to_aspect(phrase_to_aspect)
+    mark_complete()
+
+    outputs = {'reviews_dataset': REVIEWS_PATH, 'review_aspects': REVIEW_ASPECTS_PATH, 'categories_count': CATEGORIES_COUNT_PATH, 'products_count': PRODUCTS_COUNT_PATH}
+    outputs.update({f'{name}_cube': path for name, path in CUBE_PATHS.items()})
+
+    return outputs
+
+
+## requires aggregate so the index is rebuilt whenever the exported reviews change; its output paths are not read here
+@pipeline.stage('index', requires=['load', 'aggregate'], sources=['similarity_index.py', 'review_store.py', 'embeddings.py'],
+                helpers=[model_texts])
+def index_stage(context, reviews, products, reviews_dataset, review_aspects, **exported_tables):
+    exported = load_reviews(reviews['review_key'])
+    texts = reviews[['reviews_title', 'reviews_text']].iloc[review_order(exported)].reset_index(drop=True)
+
+    ## full runs find these in the embedding cache; incremental runs only encode new or changed reviews
+    embeddings = get_embeddings(model_texts(texts).to_list())
+    index, recall = build_index(embeddings)
+    save_review_texts(texts)
+
+    search = 'exact search' if recall is None else f'IVF search, recall@10 vs exact {recall:.3f}'
+    print(f'DONE! Saved {EMBEDDINGS_PATH} and {TEXTS_PATH} ({len(index)} reviews, {search})')
+
+    outputs = {'embeddings_index': EMBEDDINGS_PATH, 'review_texts': TEXTS_PATH}
+    if recall is not None:
+        outputs['ivf_index'] = IVF_PATH
+
+    return outputs
+
+
+def run(incremental=False, force=(), start=None, workers=NLP_WORKERS):
+    ## workers only changes how the NLP stages are spread over processes, not their output, so it is not part of any fingerprint
+    context = {'dataset_path': get_dataset(), 'incremental': incremental, 'workers': workers}
+
+    ## with PERF_INSTRUMENTATION=1 the stage timings and cache counters also go to the perf log
+    perf_run = start_run('precompute')
+
+    try:
+        return pipeline.run(context, force=force, start=start)
+    finally:
+        shutdown_pool()
+        stop_embed_pool()
+        finish_run(perf_run)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the processed review tables and the sentiment model')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process new or changed reviews and update the saved outputs in place')
+    parser.add_argument('--force', action='append', default=[], choices=pipeline.stage_names(), metavar='STAGE',
+                        help='re-run this stage even if its checkpoint is valid (can be repeated)')
+    parser.add_argument('--from', dest='start', choices=pipeline.stage_names(), metavar='STAGE',
+                        help='re-run this stage and every stage after it')
+    parser.add_argument('--workers', type=int, default=NLP_WORKERS,
+                        help='processes for pros/cons, keyword and lemma extraction (default: $NLP_WORKERS or 1)')
+    parser.add_argument('--list', action='store_true', help='list the stages and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(pipeline.stage_names()))
+    else:
+        run(incremental=args.incremental, force=args.force, start=args.start, workers=args.workers)
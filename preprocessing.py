@@ -1,6 +1,8 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import re
-import streamlit as st
 
 def clean_text(text):
     text = str(text).lower()
@@ -10,6 +12,31 @@ def clean_text(text):
     return text
 
 
+## Python's str.isspace() set, spelled out because Arrow's RE2 \s only matches ASCII whitespace
+OTHER_WHITESPACE = r'\t\n\x0b\x0c\r\x1c-\x1f\x{85}\x{a0}\x{1680}\x{2000}-\x{200a}\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}'
+## runs that are already a single ' ' are left alone, which avoids rewriting every word boundary
+WHITESPACE_PATTERN = f'[ {OTHER_WHITESPACE}]{{2,}}|[{OTHER_WHITESPACE}]'
+REMOVED_CHARS_PATTERN = r'[^a-zA-Z0-9 .,!?]'
+
+def clean_text_series(texts):
+    if isinstance(texts, (pa.Array, pa.ChunkedArray)):
+        values = pc.fill_null(texts.cast(pa.large_string()), 'nan')
+        index = None
+    else:
+        ## astype(str) turns missing values into 'nan'/'None' exactly like str() in clean_text
+        values = pa.array(texts.astype(str).to_numpy(dtype=object), type=pa.large_string())
+        index = texts.index
+
+    values = pc.utf8_lower(values)
+    values = pc.replace_substring_regex(values, WHITESPACE_PATTERN, ' ')
+    values = pc.replace_substring_regex(values, REMOVED_CHARS_PATTERN, '')
+
+    if index is None:
+        return values
+
+    return pd.Series(values.to_numpy(zero_copy_only=False), index=index, name=texts.name, dtype=object)
+
+
 def rating_to_sentiment(rating):
     if rating <= 2:
         return 0 ## Negative
@@ -19,7 +46,12 @@ def rating_to_sentiment(rating):
         return 2 ## Positive
     
     
-@st.cache_data
+def ratings_to_sentiment(ratings):
+    ratings = np.asarray(ratings)
+
+    return np.select([ratings <= 2, ratings == 3], [0, 1], default=2) ## Negative, Neutral, Positive
+
+
 def map_sentiment_labels(df):
     sentiment_labels = {0: 'Negative', 1: 'Neutral', 2: 'Positive'}
     df['sentiment_label'] = df['sentiment'].map(sentiment_labels)
@@ -27,33 +59,53 @@ def map_sentiment_labels(df):
     return df
 
 
-@st.cache_data
-def calc_pos_neg_percentage(row, numerator_col, denominator_col=None):
-    numerator = row[numerator_col]
+PERCENTAGE_METRICS = {
+    'Pos/Neg Percentage': ('Positive', 'Negative'),
+    'Pos/Neu Percentage': ('Positive', 'Neutral'),
+    'Neg/Neu Percentage': ('Negative', 'Neutral'),
+    'Pos/All Percentage': ('Positive', None),
+    'Neg/All Percentage': ('Negative', None),
+}
+
 
-    if denominator_col == None:
-        all_others = row['Positive'] + row['Neutral'] + row['Negative'] - numerator
-        
-        if all_others == 0 and numerator > 0:
-            return '100.0% (all positive reviews)'
-        
-        elif all_others == 0 and numerator == 0:
-            return '0.0% (no reviews)'
-        else:
-            pct = ((numerator - all_others) / all_others) * 100
-            sign = '+' if pct >= 0 else ''
+def status_column(metric):
+    return metric.replace('Percentage', 'Status')
 
-            return f'{sign}{pct:.1f}%'
 
+def calc_pos_neg_percentage(df, numerator_col, denominator_col=None):
+    numerator = df[numerator_col].to_numpy(dtype=float)
+
+    if denominator_col is None:
+        denominator = df[['Positive', 'Neutral', 'Negative']].to_numpy(dtype=float).sum(axis=1) - numerator
+        empty_status = f'all {numerator_col.lower()} reviews'
     else:
-        denominator = row[denominator_col]
+        denominator = df[denominator_col].to_numpy(dtype=float)
+        empty_status = f'no {denominator_col.lower()} reviews'
+
+    no_denominator = denominator == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = (numerator - denominator) / denominator * 100
+
+    pct = np.where(no_denominator, np.where(numerator > 0, 100.0, 0.0), pct)
+    status = np.select([no_denominator & (numerator > 0), no_denominator], [empty_status, 'no reviews'], default='')
+
+    return pct, status
+
+
+def add_percentage_columns(df):
+    for metric, (numerator_col, denominator_col) in PERCENTAGE_METRICS.items():
+        pct, status = calc_pos_neg_percentage(df, numerator_col, denominator_col)
+        df[metric] = pct
+        df[status_column(metric)] = pd.Categorical(status)
+
+    return df
+
+
+def format_percentage(pct, status):
+    pct = np.asarray(pct, dtype=float)
+    status = np.asarray(status, dtype=object)
 
-        if denominator == 0 and numerator > 0:
-            return f'100.0% (no {denominator_col.lower()} reviews)'
-        elif denominator == 0 and numerator == 0:
-            return '0.0% (no reviews)'
-        else:
-            pct = ((numerator - denominator) / denominator) * 100
-            sign = '+' if pct >= 0 else ''
+    signed = np.char.add(np.where(pct >= 0, '+', ''), np.char.mod('%.1f%%', pct))
+    noted = np.char.add(np.char.mod('%.1f%%', pct), np.char.add(' (', np.char.add(status.astype(str), ')')))
 
-            return f'{sign}{pct:.1f}%'
\ No newline at end of file
+    return np.where(status == '', signed, noted)
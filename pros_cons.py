@@ -1,35 +1,84 @@
-import spacy
-from nltk.sentiment import SentimentIntensityAnalyzer
-import pandas as pd
-import nltk
-import streamlit as st
-
-try:
-    nltk.data.find('sentiment/vader_lexicon.zip')
-except LookupError:
-    nltk.download("vader_lexicon")
-
-@st.cache_resource
+from functools import partial
+import numpy as np
+
+from memo import memoize
+from shards import run_sharded
+
+## en_core_web_sm gets sentence boundaries from the parser, the rest of the pipeline is not needed
+SENTENCE_DISABLE = ['tagger', 'attribute_ruler', 'lemmatizer', 'ner']
+
+PROS_THRESHOLD = 0.3
+CONS_THRESHOLD = -0.3
+
+@memoize
 def load_spacy_model():
+    import spacy
+
     return spacy.load("en_core_web_sm")
 
-nlp = load_spacy_model()
-sia = SentimentIntensityAnalyzer()
+@memoize
+def load_sentiment_analyzer():
+    import nltk
+    from nltk.sentiment import SentimentIntensityAnalyzer
+
+    try:
+        nltk.data.find('sentiment/vader_lexicon.zip')
+    except LookupError:
+        nltk.download("vader_lexicon")
+
+    return SentimentIntensityAnalyzer()
 
 def extract_pros_cons(text):
-    doc = nlp(text)
+    doc = load_spacy_model()(text)
+    sia = load_sentiment_analyzer()
     pros, cons = [], []
 
     for sent in doc.sents:
         score = sia.polarity_scores(sent.text)['compound']
-        if score >= 0.3:
+        if score >= PROS_THRESHOLD:
             pros.append(sent.text.strip())
-        elif score <= -0.3:
+        elif score <= CONS_THRESHOLD:
             cons.append(sent.text.strip())
             
     return ' '.join(pros), ' '.join(cons)
 
 
+def split_sentences(texts, batch_size=256, n_process=1):
+    sentences = []
+    offsets = [0]
+
+    for doc in load_spacy_model().pipe(texts, batch_size=batch_size, n_process=n_process, disable=SENTENCE_DISABLE):
+        sentences.extend(sent.text for sent in doc.sents)
+        offsets.append(len(sentences))
+
+    return sentences, offsets
+
+
+def score_sentences(sentences):
+    sia = load_sentiment_analyzer()
+    unique_scores = {}
+    for sent in sentences:
+        if sent not in unique_scores:
+            unique_scores[sent] = sia.polarity_scores(sent)['compound']
+
+    return np.array([unique_scores[sent] for sent in sentences], dtype=float)
+
+
+def extract_pros_cons_batch(texts, batch_size=256, n_process=1):
+    sentences, offsets = split_sentences(texts, batch_size=batch_size, n_process=n_process)
+    scores = score_sentences(sentences)
+
+    is_pro = scores >= PROS_THRESHOLD
+    is_con = scores <= CONS_THRESHOLD
+
+    pros, cons = [], []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        pros.append(' '.join(sentences[i].strip() for i in range(start, end) if is_pro[i]))
+        cons.append(' '.join(sentences[i].strip() for i in range(start, end) if is_con[i]))
+
+    return pros, cons
+
+
 def select_pros_cons(row):
     if row['sentiment'] == 2:
         return row['pros'], ''
@@ -37,11 +86,22 @@ def select_pros_cons(row):
         return '', row['cons']
     else:
         return row['pros'], row['cons']
+
+
+def select_pros_cons_columns(sentiment, pros, cons):
+    sentiment = np.asarray(sentiment)
+    final_pros = np.where(sentiment == 0, '', np.asarray(pros, dtype=object))
+    final_cons = np.where(sentiment == 2, '', np.asarray(cons, dtype=object))
+
+    return final_pros, final_cons
         
 
-@st.cache_data
-def process_pros_cons(df):
-    df[['pros', 'cons']] = df['reviews_text_clean'].apply(lambda x: pd.Series(extract_pros_cons(x)))
-    df[['final_pros', 'final_cons']] = df.apply(select_pros_cons, axis=1, result_type='expand')
+## not memoized: it runs once per pipeline run, and the pros_cons checkpoint is what skips it across runs
+def process_pros_cons(df, batch_size=256, n_process=1, workers=None):
+    pros, cons = run_sharded(partial(extract_pros_cons_batch, batch_size=batch_size, n_process=n_process),
+                             df['reviews_text_clean'].to_list(), workers=workers)
+    df['pros'] = pros
+    df['cons'] = cons
+    df['final_pros'], df['final_cons'] = select_pros_cons_columns(df['sentiment'], df['pros'], df['cons'])
 
-    return df
\ No newline at end of file
+    return df
@@ -0,0 +1,95 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+## a hive-partitioned dataset: one directory per primary category, rows sorted by date within each
+REVIEWS_PATH = 'processed_reviews'
+REVIEW_ASPECTS_PATH = 'processed_reviews_aspect_bridge.parquet'
+
+CATEGORY_COLUMNS = ['id', 'primaryCategories', 'sentiment_label', 'dof']
+## dashboard filters select by category and date range, so rows are clustered on those and row groups stay small enough to skip
+SORT_COLUMNS = ['primaryCategories', 'reviews_date']
+ROW_GROUP_SIZE = 16_384
+COMPRESSION = 'zstd'
+PARTITION_COLUMN = 'primaryCategories'
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor='hive')
+
+
+def review_order(reviews):
+    ## positions of the rows in review_id order; other review_id-aligned outputs (e.g. the similarity index) use it too
+    keys = reviews[SORT_COLUMNS].reset_index(drop=True).astype({'primaryCategories': 'category'})
+
+    return keys.sort_values(SORT_COLUMNS, kind='stable').index.to_numpy()
+
+
+def split_aspects(reviews):
+    ## reviews holds one row per review with the aspects as a list; returns the reviews table and the review -> aspect bridge
+    reviews = reviews.astype({column: 'category' for column in CATEGORY_COLUMNS if column in reviews} | {'reviews_rating': 'int8'})
+    reviews = reviews.iloc[review_order(reviews)].reset_index(drop=True)
+    review_ids = np.arange(len(reviews), dtype='int32')
+
+    bridge = pd.DataFrame({'review_id': review_ids, 'aspect': reviews['aspects']}).explode('aspect').dropna(subset=['aspect'])
+    bridge = bridge.astype({'review_id': 'int32', 'aspect': 'category'}).reset_index(drop=True)
+
+    reviews = reviews.drop('aspects', axis=1)
+    reviews.insert(0, 'review_id', review_ids)
+
+    return reviews, bridge
+
+
+def write_table(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path, row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION, use_dictionary=True)
+
+
+def write_dataset(df, path):
+    ## written next to the old dataset and swapped in, so readers never see a half-written one and
+    ## categories that no longer have reviews do not leave stale partitions behind
+    table = pa.Table.from_pandas(df.astype({PARTITION_COLUMN: str}), preserve_index=False)
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    ds.write_dataset(table, tmp_path, format='parquet', partitioning=PARTITIONING, basename_template='part-{i}.parquet',
+                     max_rows_per_group=ROW_GROUP_SIZE,
+                     file_options=ds.ParquetFileFormat().make_write_options(compression=COMPRESSION, use_dictionary=True))
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    os.replace(tmp_path, path)
+
+
+def review_dataset(path=REVIEWS_PATH):
+    return ds.dataset(path, format='parquet', partitioning=PARTITIONING)
+
+
+def read_reviews(path=REVIEWS_PATH, columns=None, expression=None):
+    ## rows come back in partition order; sorting by review_id makes row i review i again
+    columns = None if columns is None else list(dict.fromkeys(['review_id'] + list(columns)))
+    table = review_dataset(path).to_table(columns=columns, filter=expression)
+    reviews = table.to_pandas().sort_values('review_id', kind='stable').reset_index(drop=True)
+
+    if PARTITION_COLUMN in reviews:
+        reviews[PARTITION_COLUMN] = reviews[PARTITION_COLUMN].astype('category')
+
+    return reviews
+
+
+def write_review_tables(reviews, reviews_path=REVIEWS_PATH, aspects_path=REVIEW_ASPECTS_PATH):
+    reviews, bridge = split_aspects(reviews)
+    write_dataset(reviews, reviews_path)
+    write_table(bridge, aspects_path)
+
+    return reviews, bridge
+
+
+def load_review_tables(base_dir='.', columns=None):
+    reviews = read_reviews(os.path.join(base_dir, REVIEWS_PATH), columns=columns)
+    bridge = pd.read_parquet(os.path.join(base_dir, REVIEW_ASPECTS_PATH))
+
+    return reviews, bridge
@@ -0,0 +1,383 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+
+from preprocessing import clean_text_series
+from sentiment_inference import load_classifier, WEIGHTS_PATH, LABELS
+
+TEXT_FIELDS = ['text', 'reviews_text', 'reviews.text']
+TITLE_FIELDS = ['title', 'reviews_title', 'reviews.title']
+ID_FIELDS = ['review_id', 'id']
+
+BATCH_SIZE = 256
+MAX_WAIT_MS = 10
+
+
+def first_field(record, fields, default=None):
+    for field in fields:
+        value = record.get(field)
+        if value is not None and value == value:
+            return value
+
+    return default
+
+
+def check_record(record):
+    if not isinstance(record, dict):
+        raise ValueError('not a JSON object')
+    if first_field(record, TEXT_FIELDS) is None:
+        raise ValueError(f"none of the text fields {', '.join(TEXT_FIELDS)}")
+
+
+def check_records(records):
+    ## raises ValueError for a request that cannot be scored, before it is batched with other callers' reviews
+    if not isinstance(records, list):
+        raise ValueError('expected a review object, a list of them or {"reviews": [...]}')
+
+    for i, record in enumerate(records):
+        try:
+            check_record(record)
+        except ValueError as e:
+            raise ValueError(f'review {i}: {e}') from None
+
+
+def stub_embeddings(texts, dim):
+    ## deterministic unit vectors seeded from the text, for running the scorer without the MiniLM model
+    vectors = np.empty((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        seed = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+        vectors[i] = np.random.default_rng(seed).standard_normal(dim)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_embedder(name, dim):
+    if name == 'stub':
+        return lambda texts: stub_embeddings(texts, dim)
+
+    from embeddings import get_embeddings
+
+    return lambda texts: get_embeddings(texts, show_progress_bar=False, use_cache=False)
+
+
+class Scorer:
+    def __init__(self, embedder='minilm', weights_path=WEIGHTS_PATH):
+        self.classifier = load_classifier(weights_path)
+        self.embed = load_embedder(embedder, self.classifier.input_dim)
+
+    def prepare(self, records):
+        ## same model input as precompute: title + ' ' + cleaned review text
+        texts = pd.Series([first_field(record, TEXT_FIELDS, '') for record in records], dtype=object)
+        titles = pd.Series([first_field(record, TITLE_FIELDS, '') for record in records], dtype=object)
+
+        return (titles.astype(str) + ' ' + clean_text_series(texts)).to_list()
+
+    def score(self, records):
+        if not records:
+            return []
+
+        probabilities = self.classifier.predict_proba(self.embed(self.prepare(records)))
+        results = []
+
+        for record, row in zip(records, probabilities):
+            result = {'id': first_field(record, ID_FIELDS), 'label': LABELS[int(row.argmax())]}
+            result['probabilities'] = {label: round(float(p), 6) for label, p in zip(LABELS, row)}
+            results.append(result)
+
+        return results
+
+
+class LatencyStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.batch_sizes = []
+        self.started = None
+
+    def record(self, latency, count=1):
+        ## throughput is measured from the start of the first scored request, so an idle service is not penalised
+        with self.lock:
+            if self.started is None:
+                self.started = time.perf_counter() - latency
+            self.latencies.extend([latency] * count)
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batch_sizes.append(size)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+            started = self.started
+
+        if started is None:
+            return {'reviews': 0}
+
+        elapsed = time.perf_counter() - started
+
+        return {
+            'reviews': len(latencies),
+            'seconds': round(elapsed, 3),
+            'reviews_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(np.percentile(latencies, 50) * 1000, 2),
+            'p99_ms': round(np.percentile(latencies, 99) * 1000, 2),
+            'batches': len(batch_sizes),
+            'mean_batch_size': round(batch_sizes.mean(), 1) if len(batch_sizes) else 0,
+        }
+
+
+def iter_records(path, input_format):
+    stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+
+    try:
+        if input_format == 'csv':
+            for i, record in enumerate(csv.DictReader(stream)):
+                yield i, record
+        elif input_format == 'text':
+            for i, line in enumerate(stream):
+                if line.strip():
+                    yield i, {'text': line.rstrip('\n')}
+        else:
+            for i, line in enumerate(stream):
+                if line.strip():
+                    try:
+                        yield i, json.loads(line)
+                    except ValueError as e:
+                        ## passed on as the record, so the line gets an error result instead of ending the stream
+                        yield i, ValueError(f'invalid JSON: {e}')
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def record_error(i, record):
+    try:
+        if isinstance(record, ValueError):
+            raise record
+        check_record(record)
+    except ValueError as e:
+        return {'line': i, 'error': str(e)}
+
+    return None
+
+
+def iter_batches(records, batch_size):
+    ## yields lists of (record, error) pairs; a bad record keeps its place in the output as an error line
+    batch = []
+    for i, record in records:
+        error = record_error(i, record)
+        ## the line number is only the id of records that do not bring their own
+        if error is None and first_field(record, ID_FIELDS) is None:
+            record['review_id'] = i
+        batch.append((record, error))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def score_stream(scorer, records, output, batch_size=BATCH_SIZE):
+    ## results are written and flushed batch by batch, so a downstream reader sees them as they are scored
+    stats = LatencyStats()
+
+    for batch in iter_batches(records, batch_size):
+        valid = [record for record, error in batch if error is None]
+        started = time.perf_counter()
+        scored = iter(scorer.score(valid))
+        stats.record(time.perf_counter() - started, len(valid))
+        stats.record_batch(len(valid))
+        results = [next(scored) if error is None else error for _, error in batch]
+
+        output.write(''.join(json.dumps(result) + '\n' for result in results))
+        output.flush()
+
+    return stats.summary()
+
+
+class MicroBatcher:
+    ## concurrent callers enqueue their reviews; one worker scores whatever has arrived, up to max_batch_size
+    ## reviews or max_wait after the first one, so requests share embedding batches
+    def __init__(self, scorer, max_batch_size=BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, records):
+        check_records(records)
+        future = Future()
+        self.requests.put((records, future, time.perf_counter()))
+
+        return future
+
+    def collect(self):
+        pending = [self.requests.get()]
+        size = len(pending[0][0])
+        deadline = time.perf_counter() + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            pending.append(request)
+            size += len(request[0])
+
+        return pending
+
+    def run(self):
+        while True:
+            pending = self.collect()
+            ## when a merged batch fails, each request is scored on its own, so only the one at fault fails
+            if not self.score_batch(pending, fail_futures=len(pending) == 1):
+                for request in pending:
+                    self.score_batch([request], fail_futures=True)
+
+    def score_batch(self, pending, fail_futures):
+        records = [record for request_records, _, _ in pending for record in request_records]
+
+        try:
+            results = self.scorer.score(records)
+        except Exception as e:
+            if fail_futures:
+                for _, future, _ in pending:
+                    future.set_exception(e)
+            return fail_futures
+
+        self.stats.record_batch(len(records))
+        finished = time.perf_counter()
+        offset = 0
+
+        for request_records, future, submitted in pending:
+            future.set_result(results[offset:offset + len(request_records)])
+            offset += len(request_records)
+            self.stats.record(finished - submitted, len(request_records))
+
+        return True
+
+
+def make_handler(batcher):
+    class ScoreHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, batcher.stats.summary())
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': 'not found'})
+                return
+
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                self.send_json(400, {'error': 'body must be JSON'})
+                return
+
+            records = payload.get('reviews', [payload]) if isinstance(payload, dict) else payload
+            if isinstance(records, dict):
+                records = [records]
+
+            try:
+                future = batcher.submit(records)
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+
+            try:
+                results = future.result()
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+
+            self.send_json(200, {'results': results})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoreHandler
+
+
+class ScoreServer(ThreadingHTTPServer):
+    daemon_threads = True
+    ## many callers connect at once when they are meant to share batches
+    request_queue_size = 128
+
+
+def serve(scorer, host, port, max_batch_size, max_wait_ms):
+    batcher = MicroBatcher(scorer, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    server = ScoreServer((host, port), make_handler(batcher))
+    print(f'Scoring reviews on http://{host}:{server.server_port}/score (stats on /stats)', file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.summary()), file=sys.stderr)
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+
+    return {'.csv': 'csv', '.txt': 'text'}.get(extension, 'jsonl')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify reviews with the saved sentiment model')
+    parser.add_argument('input', nargs='?', default='-', help='JSONL, CSV or text file of reviews; - reads stdin')
+    parser.add_argument('--format', choices=['jsonl', 'csv', 'text'], help='input format (default: from the file extension, jsonl for stdin)')
+    parser.add_argument('--output', default='-', help='JSONL file for the results; - writes stdout')
+    parser.add_argument('--embedder', choices=['minilm', 'stub'], default='minilm', help='stub uses hash-seeded vectors instead of MiniLM')
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--serve', action='store_true', help='run a local HTTP scoring service instead of scoring the input')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS, help='longest a request waits for others to share its batch')
+    args = parser.parse_args()
+
+    scorer = Scorer(embedder=args.embedder, weights_path=args.weights)
+
+    if args.serve:
+        serve(scorer, args.host, args.port, args.batch_size, args.max_wait_ms)
+    else:
+        records = iter_records(args.input, args.format or detect_format(args.input))
+        output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+
+        try:
+            summary = score_stream(scorer, records, output, batch_size=args.batch_size)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        print(json.dumps(summary), file=sys.stderr)
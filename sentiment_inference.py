@@ -0,0 +1,117 @@
+import json
+import numpy as np
+
+WEIGHTS_PATH = 'sentiment_model.npz'
+WEIGHT_DTYPES = ['float32', 'float16', 'int8']
+LABELS = ['Negative', 'Neutral', 'Positive']
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    np.exp(x, out=x)
+
+    return x / x.sum(axis=1, keepdims=True)
+
+
+def linear(x):
+    return x
+
+
+ACTIVATIONS = {'relu': relu, 'softmax': softmax, 'linear': linear}
+
+
+def quantize(kernel, dtype):
+    ## int8 kernels use one symmetric scale per output unit
+    if dtype == 'int8':
+        scale = np.abs(kernel).max(axis=0) / 127
+        scale[scale == 0] = 1
+        return np.round(kernel / scale).astype(np.int8), scale.astype(np.float32)
+
+    return kernel.astype(dtype), None
+
+
+def save_weights(path, kernels, biases, activations, dtype='float32'):
+    if dtype not in WEIGHT_DTYPES:
+        raise ValueError(f'dtype must be one of {WEIGHT_DTYPES}, got {dtype!r}')
+
+    arrays = {'activations': np.array(activations)}
+
+    for i, (kernel, bias) in enumerate(zip(kernels, biases)):
+        arrays[f'kernel_{i}'], scale = quantize(np.asarray(kernel, dtype=np.float32), dtype)
+        arrays[f'bias_{i}'] = np.asarray(bias, dtype=np.float32)
+        if scale is not None:
+            arrays[f'scale_{i}'] = scale
+
+    np.savez_compressed(path, **arrays)
+
+    return path
+
+
+def export_h5_weights(h5_path, path=WEIGHTS_PATH, dtype='float32'):
+    ## reads the Dense layers of a Keras .h5 file with h5py, so converting a saved model does not need TensorFlow
+    import h5py
+
+    kernels, biases, activations = [], [], []
+
+    with h5py.File(h5_path, 'r') as f:
+        config = json.loads(f.attrs['model_config'])
+        layer_weights = f['model_weights']
+
+        for layer in config['config']['layers']:
+            if layer['class_name'] != 'Dense':
+                continue
+
+            group = layer_weights[layer['config']['name']]
+            weights = {name.decode() if isinstance(name, bytes) else name: group[name][()] for name in group.attrs['weight_names']}
+            kernels.append(next(value for name, value in weights.items() if name.split('/')[-1].startswith('kernel')))
+            biases.append(next(value for name, value in weights.items() if name.split('/')[-1].startswith('bias')))
+            activations.append(layer['config']['activation'])
+
+    return save_weights(path, kernels, biases, activations, dtype=dtype)
+
+
+class SentimentClassifier:
+    def __init__(self, kernels, biases, activations):
+        self.layers = [(kernel, bias, ACTIVATIONS[activation]) for kernel, bias, activation in zip(kernels, biases, activations)]
+
+    @property
+    def input_dim(self):
+        return self.layers[0][0].shape[0]
+
+    def predict_proba(self, X, batch_size=8192):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        output = np.empty((len(X), self.layers[-1][0].shape[1]), dtype=np.float32)
+
+        for start in range(0, len(X), batch_size):
+            x = X[start:start + batch_size]
+            for kernel, bias, activation in self.layers:
+                x = activation(x @ kernel + bias)
+            output[start:start + batch_size] = x
+
+        return output
+
+    def predict(self, X, batch_size=8192):
+        return self.predict_proba(X, batch_size=batch_size).argmax(axis=1)
+
+
+def load_classifier(path=WEIGHTS_PATH):
+    ## weights are dequantized to float32 once here; the forward pass always runs in float32
+    with np.load(path) as weights:
+        activations = [str(activation) for activation in weights['activations']]
+        kernels, biases = [], []
+
+        for i in range(len(activations)):
+            kernel = weights[f'kernel_{i}'].astype(np.float32)
+            if f'scale_{i}' in weights:
+                kernel *= weights[f'scale_{i}']
+            kernels.append(kernel)
+            biases.append(weights[f'bias_{i}'])
+
+    return SentimentClassifier(kernels, biases, activations)
@@ -1,7 +1,7 @@
 from tensorflow.keras import layers, models
-import streamlit as st
 
-@st.cache_resource
+from sentiment_inference import save_weights, WEIGHTS_PATH
+
 def build_nn(input_dim):
     model_nn = models.Sequential([
         layers.Input(shape=(input_dim,)),
@@ -14,8 +14,16 @@ def build_nn(input_dim):
 
     return model_nn
 
-@st.cache_resource
 def train_nn_model(model, X_train, y_train):
     model.fit(X_train, y_train, validation_split=0.1, epochs=5, batch_size=128, verbose=0)
 
-    return model
\ No newline at end of file
+    return model
+
+def export_model_weights(model, path=WEIGHTS_PATH, dtype='float32'):
+    ## dropout is a no-op at inference, so only the Dense layers are exported for sentiment_inference
+    dense_layers = [layer for layer in model.layers if isinstance(layer, layers.Dense)]
+    kernels = [layer.get_weights()[0] for layer in dense_layers]
+    biases = [layer.get_weights()[1] for layer in dense_layers]
+    activations = [layer.get_config()['activation'] for layer in dense_layers]
+
+    return save_weights(path, kernels, biases, activations, dtype=dtype)
@@ -0,0 +1,105 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+import numpy as np
+
+NLP_WORKERS = int(os.environ.get('NLP_WORKERS', '1'))
+## more shards than workers, so a slow shard does not leave the other workers idle at the end of a stage
+SHARDS_PER_WORKER = 4
+SHARD_RETRIES = 2
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+_pool = None
+_pool_workers = 0
+
+
+class ShardError(RuntimeError):
+    pass
+
+
+def init_worker(threads):
+    ## set before spaCy, torch or numpy's BLAS are imported in the worker, so workers do not oversubscribe the cores
+    for variable in THREAD_VARIABLES:
+        os.environ.setdefault(variable, str(threads))
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+
+def get_pool(workers):
+    ## one pool is kept for the whole run; models are loaded lazily in each worker and stay loaded for later stages
+    global _pool, _pool_workers
+
+    if _pool is None or _pool_workers != workers:
+        shutdown_pool()
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=init_worker, initargs=(threads,))
+        _pool_workers = workers
+
+    return _pool
+
+
+def shutdown_pool():
+    global _pool, _pool_workers
+
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+    _pool, _pool_workers = None, 0
+
+
+def shard_bounds(n_items, n_shards):
+    edges = np.linspace(0, n_items, min(n_shards, n_items) + 1).astype(int)
+
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def combine(results):
+    ## shard results are joined in shard order, so the output does not depend on the number of workers
+    first = results[0]
+    if isinstance(first, tuple):
+        return tuple(combine(list(parts)) for parts in zip(*results))
+    if isinstance(first, np.ndarray):
+        return np.concatenate(results)
+
+    return list(chain.from_iterable(results))
+
+
+def run_sharded(func, *columns, workers=None, retries=SHARD_RETRIES):
+    ## func takes aligned slices of columns and returns a list (or a tuple of lists) with one entry per item
+    workers = workers or NLP_WORKERS
+    n_items = len(columns[0])
+
+    if workers <= 1 or n_items < 2:
+        return func(*columns)
+
+    bounds = shard_bounds(n_items, workers * SHARDS_PER_WORKER)
+    results = [None] * len(bounds)
+    attempts = [0] * len(bounds)
+    pending = set(range(len(bounds)))
+
+    while pending:
+        pool = get_pool(workers)
+        futures = {pool.submit(func, *[column[start:stop] for column in columns]): shard
+                   for shard, (start, stop) in enumerate(bounds) if shard in pending}
+
+        broken = False
+
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                results[shard] = future.result()
+                pending.discard(shard)
+            except Exception as e:
+                attempts[shard] += 1
+                if attempts[shard] > retries:
+                    shutdown_pool()
+                    raise ShardError(f'Shard {shard} (items {bounds[shard][0]}-{bounds[shard][1]}) failed {attempts[shard]} times') from e
+                print(f'Shard {shard} failed ({e!r}), retrying')
+                ## a worker that died takes the pool with it; the failed shards are retried in a new one
+                broken = broken or isinstance(e, BrokenProcessPool)
+
+        if broken:
+            shutdown_pool()
+
+    return combine(results)
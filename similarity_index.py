@@ -0,0 +1,175 @@
+import os
+import numpy as np
+
+EMBEDDINGS_PATH = 'processed_reviews_embeddings.npy'
+IVF_PATH = 'processed_reviews_ivf.npz'
+TEXTS_PATH = 'processed_reviews_texts.parquet'
+
+BLOCK_SIZE = 65_536
+## below this many reviews a blocked brute-force scan takes a few milliseconds, so no coarse quantizer is built
+IVF_MIN_ROWS = 20_000
+## KMeans is trained on about this many reviews per inverted list
+IVF_SAMPLE_PER_LIST = 40
+## n_probe is tuned at build time to the smallest power of two that reaches this recall against exact search
+TARGET_RECALL = 0.95
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return vectors / norms
+
+
+def save_embeddings(embeddings, path=EMBEDDINGS_PATH):
+    ## unit-normalized float16 rows in review_id order; np.load(mmap_mode='r') maps it without reading it all
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=embeddings.shape)
+    for start in range(0, len(embeddings), BLOCK_SIZE):
+        matrix[start:start + BLOCK_SIZE] = normalize(embeddings[start:start + BLOCK_SIZE])
+    matrix.flush()
+
+    return path
+
+
+def load_embeddings(path=EMBEDDINGS_PATH):
+    return np.load(path, mmap_mode='r')
+
+
+def top_k(scores, ids, k):
+    ## ids holds the candidate ids for the columns of scores, shared (1-d) or per query (2-d)
+    k = min(k, scores.shape[1])
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    ranked = np.argsort(-best_scores, axis=1, kind='stable')
+    best = np.take_along_axis(best, ranked, axis=1)
+    best_ids = ids[best] if ids.ndim == 1 else np.take_along_axis(ids, best, axis=1)
+
+    return best_ids, np.take_along_axis(best_scores, ranked, axis=1)
+
+
+def brute_force_search(embeddings, queries, k=10, block_size=BLOCK_SIZE):
+    queries = normalize(queries).reshape(-1, embeddings.shape[1])
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        ids = np.arange(start, start + len(block))
+        block_ids, block_scores = top_k(queries @ block.T, ids, k)
+        best_ids, best_scores = top_k(np.concatenate([best_scores, block_scores], axis=1), np.concatenate([best_ids, block_ids], axis=1), k)
+
+    return best_ids, best_scores
+
+
+def assign_lists(embeddings, centroids, block_size=BLOCK_SIZE):
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        assignments[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+
+    return assignments
+
+
+def build_ivf(embeddings, n_lists=None, random_state=123):
+    ## coarse quantizer: KMeans centroids on a sample, then every review goes to its nearest centroid's inverted list
+    from sklearn.cluster import KMeans
+
+    n_lists = n_lists or max(int(np.sqrt(len(embeddings))), 1)
+    rng = np.random.default_rng(random_state)
+    sample = np.sort(rng.choice(len(embeddings), size=min(IVF_SAMPLE_PER_LIST * n_lists, len(embeddings)), replace=False))
+
+    kmeans = KMeans(n_clusters=n_lists, n_init=1, random_state=random_state).fit(np.asarray(embeddings[sample], dtype=np.float32))
+    centroids = normalize(kmeans.cluster_centers_)
+
+    assignments = assign_lists(embeddings, centroids)
+    order = np.argsort(assignments, kind='stable').astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+    return {'centroids': centroids, 'order': order, 'offsets': offsets}
+
+
+class SimilarityIndex:
+    def __init__(self, embeddings, ivf=None):
+        self.embeddings = embeddings
+        self.ivf = ivf
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def search_exact(self, queries, k=10):
+        return brute_force_search(self.embeddings, queries, k)
+
+    def search(self, queries, k=10, n_probe=None):
+        if self.ivf is None:
+            return self.search_exact(queries, k)
+
+        n_probe = n_probe or int(self.ivf['n_probe'])
+
+        queries = normalize(queries).reshape(-1, self.embeddings.shape[1])
+        centroids, order, offsets = self.ivf['centroids'], self.ivf['order'], self.ivf['offsets']
+        probes = np.argsort(-(queries @ centroids.T), axis=1)[:, :n_probe]
+
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        for i, lists in enumerate(probes):
+            ## sorted ids keep the reads from the memory-mapped matrix roughly sequential
+            candidates = np.sort(np.concatenate([order[offsets[j]:offsets[j + 1]] for j in lists]))
+            if not len(candidates):
+                continue
+            candidate_ids, candidate_scores = top_k(queries[i:i + 1] @ np.asarray(self.embeddings[candidates], dtype=np.float32).T, candidates, k)
+            ids[i, :candidate_ids.shape[1]] = candidate_ids[0]
+            scores[i, :candidate_scores.shape[1]] = candidate_scores[0]
+
+        return ids, scores
+
+    def recall(self, queries, k=10, n_probe=None, exact=None):
+        exact = self.search_exact(queries, k)[0] if exact is None else exact
+        approximate, _ = self.search(queries, k, n_probe)
+
+        return np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approximate, exact)])
+
+
+def build_index(embeddings, embeddings_path=EMBEDDINGS_PATH, ivf_path=IVF_PATH, n_lists=None, n_queries=200, k=10):
+    save_embeddings(embeddings, embeddings_path)
+    matrix = load_embeddings(embeddings_path)
+
+    if len(matrix) < IVF_MIN_ROWS and n_lists is None:
+        if os.path.exists(ivf_path):
+            os.remove(ivf_path)
+        return SimilarityIndex(matrix), None
+
+    ivf = build_ivf(matrix, n_lists=n_lists)
+    index = SimilarityIndex(matrix, ivf)
+
+    ## recall of the IVF search against exact search, using stored reviews as queries
+    queries = np.asarray(matrix[np.random.default_rng(0).choice(len(matrix), size=min(n_queries, len(matrix)), replace=False)], dtype=np.float32)
+    exact, _ = index.search_exact(queries, k)
+    n_probe = 1
+    while True:
+        recall = index.recall(queries, k=k, n_probe=n_probe, exact=exact)
+        if recall >= TARGET_RECALL or n_probe >= len(ivf['centroids']):
+            break
+        n_probe = min(n_probe * 2, len(ivf['centroids']))
+
+    ivf.update(recall=recall, k=k, n_probe=n_probe)
+    np.savez(ivf_path, **ivf)
+
+    return index, recall
+
+
+def load_index(embeddings_path=EMBEDDINGS_PATH, ivf_path=IVF_PATH):
+    ivf = None
+    if os.path.exists(ivf_path):
+        with np.load(ivf_path) as stored:
+            ivf = {name: stored[name] for name in stored.files}
+
+    return SimilarityIndex(load_embeddings(embeddings_path), ivf)
+
+
+def save_review_texts(texts, path=TEXTS_PATH):
+    ## title and text in review_id order, for showing the neighbours
+    texts.reset_index(drop=True).to_parquet(path, index=False, compression='zstd')
+
+    return path
@@ -0,0 +1,104 @@
+import os
+import pandas as pd
+import pytest
+
+import precompute
+from incremental import add_review_keys
+from review_store import read_reviews
+
+ASPECTS = {f'phrase {rating}': aspect for rating, aspect in zip(range(1, 6), ['price', 'battery', 'screen', 'sound', 'quality'])}
+
+
+def make_reviews(n, start=0):
+    rows = range(start, start + n)
+
+    return pd.DataFrame({
+        'id': pd.Categorical([f'product-{i % 3}' for i in rows]),
+        'brand': pd.Categorical(['Amazon'] * n),
+        'primaryCategories': pd.Categorical([['Electronics', 'Health & Beauty'][i % 2] for i in rows]),
+        'reviews_date': [f'2016-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:00.000Z' for i in rows],
+        'reviews_rating': [1 + i % 5 for i in rows],
+        'reviews_text': [f'Review number {i} of this product.' for i in rows],
+        'reviews_title': [f'Title {i}' for i in rows],
+    })
+
+
+PRODUCTS = pd.DataFrame({'id': [f'product-{i}' for i in range(3)], 'name': ['Echo', 'Kindle', 'Fire TV']})
+
+
+def use_dir(path, monkeypatch):
+    path.mkdir()
+    monkeypatch.chdir(path)
+
+
+def run_aggregate(reviews, incremental):
+    context = {'incremental': incremental}
+    reviews = add_review_keys(reviews.reset_index(drop=True))
+    cleaned = precompute.clean_stage(context, reviews, PRODUCTS)
+    changed = cleaned['changed']
+    phrases = pd.DataFrame({'normalized_phrases': [[f'phrase {rating}'] for rating in changed['reviews_rating']]})
+    phrase_to_aspect = pd.DataFrame({'phrase': list(ASPECTS), 'aspect': list(ASPECTS.values())})
+
+    return precompute.aggregate_stage(context, reviews, PRODUCTS, changed, cleaned['stale'], phrases, phrase_to_aspect)
+
+
+def read_outputs(outputs):
+    tables = {}
+    for name, path in outputs.items():
+        table = read_reviews(path) if os.path.isdir(path) else pd.read_parquet(path)
+        tables[name] = table.sort_values(list(table.columns)).reset_index(drop=True)
+
+    return tables
+
+
+def assert_same_tables(left, right):
+    assert left.keys() == right.keys()
+    for name in left:
+        pd.testing.assert_frame_equal(left[name], right[name], obj=name)
+
+
+@pytest.fixture
+def updated_reviews():
+    base = make_reviews(60)
+    ## drops some reviews, adds new ones and changes the rating of one
+    updated = pd.concat([base.iloc[10:], make_reviews(15, start=100)], ignore_index=True)
+    updated.loc[0, 'reviews_rating'] = 5 if updated.loc[0, 'reviews_rating'] != 5 else 1
+
+    return base, updated
+
+
+def test_incremental_run_matches_full_rebuild(tmp_path, monkeypatch, updated_reviews):
+    base, updated = updated_reviews
+
+    use_dir(tmp_path / 'full', monkeypatch)
+    full = read_outputs(run_aggregate(updated, incremental=False))
+
+    use_dir(tmp_path / 'incremental', monkeypatch)
+    run_aggregate(base, incremental=False)
+    incremental = read_outputs(run_aggregate(updated, incremental=True))
+
+    assert_same_tables(full, incremental)
+
+
+## before and after the count tables are updated, half way through saving the state, and just before it is marked complete
+@pytest.mark.parametrize('failing_step', ['write_cubes', 'update_count_table', 'write_partition', 'save_phrase_to_aspect'])
+def test_failed_incremental_run_is_repaired_by_the_next_one(tmp_path, monkeypatch, updated_reviews, failing_step):
+    base, updated = updated_reviews
+
+    use_dir(tmp_path / 'full', monkeypatch)
+    full = read_outputs(run_aggregate(updated, incremental=False))
+
+    use_dir(tmp_path / 'incremental', monkeypatch)
+    run_aggregate(base, incremental=False)
+
+    def fail(*args):
+        raise RuntimeError('disk full')
+
+    with monkeypatch.context() as patched:
+        patched.setattr(precompute, failing_step, fail)
+        with pytest.raises(RuntimeError):
+            run_aggregate(updated, incremental=True)
+
+    incremental = read_outputs(run_aggregate(updated, incremental=True))
+
+    assert_same_tables(full, incremental)
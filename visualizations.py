@@ -2,13 +2,21 @@ import plotly.express as px
 import plotly.graph_objects as go
 import streamlit as st
 import pandas as pd
-import re
-
-from data_loader import get_dataset
-
+import numpy as np
+import time
+
+from preprocessing import clean_text, format_percentage, status_column
+from data_access import (read_table, read_reviews, product_names, product_categories, similarity_index, daily_rollup, category_options,
+                         filtered_percentage_table, ReviewFilters, NO_FILTERS)
+from incremental import SENTIMENTS
+from aggregates import GRANULARITIES, rollup_series
+from similarity_index import TEXTS_PATH
+from instrumentation import instrument, cache_miss
+
+@instrument('chart')
 @st.cache_data
-def reviews_by_aspect(df):
-    count_df = df[['aspects', 'sentiment_label']].value_counts().reset_index()
+@cache_miss
+def reviews_by_aspect(count_df):
     color_map = {'Negative': 'red', 'Neutral': 'gray', 'Positive': 'green'}
     fig = px.bar(count_df, x='aspects', y='count', color='sentiment_label', color_discrete_map=color_map, barmode='stack')
     fig.update_xaxes(
@@ -24,41 +32,79 @@ def reviews_by_aspect(df):
     return fig
 
 
-@st.cache_data
-def prepare_reviews_over_time(df):
-    time_df = df[['reviews_date', 'primaryCategories', 'sentiment_label']].value_counts().reset_index()
-    time_df['primaryCategories'] = time_df['primaryCategories'].str.split(',')
-    time_df = time_df.explode('primaryCategories')
-    time_df['primaryCategories'] = time_df['primaryCategories'].str.strip()
-    time_df = time_df[(time_df['reviews_date'] > '2016-01-01') & (time_df['reviews_date'] <= '2016-12-31')]
-    time_df = time_df.sort_values('reviews_date')
+DEFAULT_DATE_RANGE = (pd.Timestamp('2016-01-01').date(), pd.Timestamp('2016-12-31').date())
+
+
+def review_filters():
+    ## one set of filters for every chart; with nothing narrowed the charts use the precomputed cubes
+    st.sidebar.header('Filters')
+    categories = st.sidebar.multiselect('Categories', options=category_options())
+
+    products = product_categories()
+    if categories:
+        products = products[[bool(set(categories) & set(str(value).split(','))) for value in products]]
+    names = product_names()
+    product_ids = st.sidebar.multiselect('Products', options=list(products.index), format_func=lambda product_id: names.get(product_id, product_id))
+
+    sentiments = st.sidebar.multiselect('Sentiments', options=SENTIMENTS)
+
+    rollup = daily_rollup()
+    first_day, last_day = rollup.index[0].date(), rollup.index[-1].date()
+    start, end = st.sidebar.slider('Review dates', min_value=first_day, max_value=last_day, value=(first_day, last_day), format='YYYY-MM-DD')
+
+    ## the full range is no filter, so reviews without a date still count
+    return ReviewFilters(categories=tuple(categories), products=tuple(map(str, product_ids)), sentiments=tuple(sentiments),
+                         start=None if start == first_day else start.isoformat(), end=None if end == last_day else end.isoformat())
+
+
+@instrument('chart')
+def prepare_reviews_over_time(rollup, start, end, sentiment, granularity):
+    return rollup_series(rollup, pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC'),
+                         None if sentiment == 'All' else sentiment, granularity)
 
-    return time_df
 
+@instrument('chart')
+def reviews_over_time(rollup):
+    if rollup.empty:
+        st.info('No reviews match the filters')
+        return None
+
+    first_day, last_day = rollup.index[0].date(), rollup.index[-1].date()
+
+    ## 2016 by default, as before, or the whole history when the data does not cover it
+    default_range = (max(first_day, DEFAULT_DATE_RANGE[0]), min(last_day, DEFAULT_DATE_RANGE[1]))
+    if default_range[0] >= default_range[1]:
+        default_range = (first_day, last_day)
 
-def reviews_over_time(df):
-    sentiment = st.selectbox('Select Sentiment', options=['All', 'Negative', 'Neutral', 'Positive'])
+    col1, col2 = st.columns([1, 1])
+    sentiments = [sentiment for sentiment in SENTIMENTS if sentiment in rollup.columns.get_level_values('sentiment_label')]
+    sentiment = col1.selectbox('Select Sentiment', options=['All'] + sentiments)
+    granularity = col2.radio('Granularity', options=list(GRANULARITIES), horizontal=True)
+    if first_day < last_day:
+        start, end = st.slider('Date range', min_value=first_day, max_value=last_day, value=default_range, format='YYYY-MM-DD')
+    else:
+        start, end = first_day, last_day
 
-    time_df = prepare_reviews_over_time(df)
+    time_df = prepare_reviews_over_time(rollup, start, end, sentiment, granularity)
 
     color_map = {'Health & Beauty': 'red', 'Electronics': 'blue', 'Media': 'green', 'Toys & Games': 'black', 'Office Supplies': 'orange'}
-    
+
+    fig = px.line(time_df, x='reviews_date', y='count', color='primaryCategories', color_discrete_map=color_map, markers=True,
+                  hover_data={'days': True, 'partial': True}, labels={'days': 'Days in range', 'partial': 'Partial bucket'})
+
     if sentiment == 'All':
-        fig = px.line(time_df, x='reviews_date', y='count', color='primaryCategories', color_discrete_map=color_map, markers=True)
         fig.update_layout(
-            title='Number of Reviews Over Time by Primary Categories'
+            title=f'Number of Reviews per {granularity} by Primary Categories'
         )
     
     else:
-        fig = px.line(time_df[time_df['sentiment_label'] == sentiment], x='reviews_date', y='count', color='primaryCategories',
-                      color_discrete_map=color_map, markers=True)
         fig.update_layout(
-            title=f'Number of {sentiment} Reviews Over Time by Primary Categories'
+            title=f'Number of {sentiment} Reviews per {granularity} by Primary Categories'
         )
 
     fig.update_traces(mode='markers+lines')
     fig.update_xaxes(
-        title_text='Date (year 2016)'
+        title_text=f'Date ({start:%Y-%m-%d} to {end:%Y-%m-%d})'
     )
     fig.update_yaxes(
         title_text='Number of Reviews'
@@ -67,15 +113,10 @@ def reviews_over_time(df):
     return fig
 
 
+@instrument('chart')
 @st.cache_data
-def reviews_by_day_month(df):
-    date_df = df.copy()
-    date_df['month'] = date_df['reviews_date'].dt.month
-    date_df['day'] = date_df['reviews_date'].dt.day
-    date_df['dof'] = date_df['reviews_date'].dt.day_name()
-    date_df['hour'] = date_df['reviews_date'].dt.hour
-
-    month_day_df = date_df[['month', 'day', 'sentiment_label']].value_counts().reset_index()
+@cache_miss
+def reviews_by_day_month(month_day_df):
     color_map = {'Negative': 'red', 'Neutral': 'gray', 'Positive': 'green'}
     fig = px.scatter(month_day_df,x='month', y='day', color='sentiment_label', size='count', size_max=40, color_discrete_map=color_map)
     fig.update_layout(
@@ -105,15 +146,10 @@ def reviews_by_day_month(df):
     return fig
 
 
+@instrument('chart')
 @st.cache_data
-def reviews_by_dof_and_sentiment(df):
-    date_df = df.copy()
-    date_df['month'] = date_df['reviews_date'].dt.month
-    date_df['day'] = date_df['reviews_date'].dt.day
-    date_df['dof'] = date_df['reviews_date'].dt.day_name()
-    date_df['hour'] = date_df['reviews_date'].dt.hour
-
-    dof_sentiment_df = date_df[['dof','sentiment_label']].value_counts().reset_index()
+@cache_miss
+def reviews_by_dof_and_sentiment(dof_sentiment_df):
     color_map = {'Negative': 'red', 'Neutral': 'gray', 'Positive': 'green'}
     fig = px.bar(dof_sentiment_df, x='dof', y='count', color='sentiment_label', color_discrete_map=color_map, barmode='stack')
     fig.update_layout(
@@ -133,13 +169,17 @@ def reviews_by_dof_and_sentiment(df):
     return fig
 
 
-def reviews_table(df):
-    products_df = df[['id', 'sentiment_label']].value_counts().reset_index(name='count')
+@instrument('chart')
+def prepare_reviews_table(products_df):
+    products_df = products_df.copy()
+    products_df['name'] = products_df['id'].map(product_names())
+
+    return products_df
 
-    original_df = pd.read_parquet('original_data.parquet')
-    original_df = original_df[['id', 'name']].drop_duplicates()
 
-    products_df = products_df.merge(original_df, on='id', how='left')
+@instrument('chart')
+def reviews_table(products_df):
+    products_df = prepare_reviews_table(products_df)
 
     sentiments = st.multiselect('Select Sentiments', options=products_df['sentiment_label'].unique(), default=products_df['sentiment_label'].unique())
 
@@ -154,26 +194,30 @@ def reviews_table(df):
     return fig
 
 
-def parse_percentage(value):
-    if isinstance(value, str):
-        match = re.search(r'([+-]?\d+(\.\d+)?)%', value)
-        if match:
-            return float(match.group(1))
-        else:
-            return None
-    return value
+PERCENTAGE_TABLES = {
+    'Products': ('processed_reviews_products_count.parquet', 'name'),
+    'Categories': ('processed_reviews_categories_count.parquet', 'primaryCategories'),
+}
+
+
+@instrument('load')
+def load_percentage_table(products_or_categories, sentiments, filters=NO_FILTERS):
+    path, id_col = PERCENTAGE_TABLES[products_or_categories]
+    columns = [id_col] + sentiments + [status_column(col) for col in sentiments]
 
+    if filters != NO_FILTERS:
+        return filtered_percentage_table(filters, id_col)[columns]
 
-def reviews_percentage_diff(products_or_categories):
+    return read_table(path, columns=columns)
+
+
+@instrument('chart')
+def reviews_percentage_diff(products_or_categories, filters=NO_FILTERS):
     if products_or_categories == 'Products':
-        df = pd.read_parquet('processed_reviews_products_count.parquet')
         available_tops = ['Top 10 Highest', 'Top 10 Lowest', 'All Products']
         tops = st.selectbox('Choose top of products to display', available_tops)
 
-    elif products_or_categories == 'Categories':
-        df = pd.read_parquet('processed_reviews_categories_count.parquet')
-
-    else:
+    elif products_or_categories != 'Categories':
         st.write('Plese select an option')
         return None
 
@@ -186,19 +230,17 @@ def reviews_percentage_diff(products_or_categories):
         st.warning('Please pick one')
         return None
 
-    df_plot = df.copy()
-
-    for col in sentiments:
-        df_plot[col + '_num'] = df_plot[col].apply(parse_percentage)
+    df = load_percentage_table(products_or_categories, sentiments, filters)
 
     if products_or_categories == 'Products':
-        df_plot = df_plot.melt(id_vars='name', value_vars=[s + '_num' for s in sentiments], var_name='sentimentMetric', value_name='value')
+        df_plot = df.melt(id_vars='name', value_vars=sentiments, var_name='sentimentMetric', value_name='value')
     elif products_or_categories == 'Categories':
-        df_plot = df_plot.melt(id_vars='primaryCategories', value_vars=[s + '_num' for s in sentiments], var_name='sentimentMetric', value_name='value')
+        df_plot = df.melt(id_vars='primaryCategories', value_vars=sentiments, var_name='sentimentMetric', value_name='value')
 
-    df_plot['sentimentMetric'] = df_plot['sentimentMetric'].str.replace('_num', '')
+    statuses = pd.concat([df[status_column(col)].astype(str) for col in sentiments], ignore_index=True)
+    df_plot['label'] = format_percentage(df_plot['value'], statuses)
 
-    df_plot['color'] = df_plot['value'].apply(lambda x: 'green' if x >= 0 else 'red')
+    df_plot['color'] = np.where(df_plot['value'] >= 0, 'green', 'red')
 
     if products_or_categories == 'Products':
         if tops == 'Top 10 Highest':
@@ -207,7 +249,7 @@ def reviews_percentage_diff(products_or_categories):
             df_plot = df_plot.sort_values(by='value', ascending=True).groupby('sentimentMetric').head(10)
         
         fig = px.bar(df_plot, x='name', y='value', color='color', color_discrete_map={'green': 'green', 'red': 'red'},
-                 facet_col='sentimentMetric', text=df_plot['value'])
+                 facet_col='sentimentMetric', text=df_plot['label'])
         
         fig.update_xaxes(
             title_text='Products',ticktext=[n[:40] for n in df_plot['name']], tickvals=df_plot['name']
@@ -216,7 +258,7 @@ def reviews_percentage_diff(products_or_categories):
     elif products_or_categories == 'Categories':
         df_plot = df_plot.sort_values(by='value', ascending=False)
         fig = px.bar(df_plot, x='primaryCategories', y='value', color='color',
-                     color_discrete_map={'green': 'green', 'red': 'red'},facet_col='sentimentMetric', text=df_plot['value']
+                     color_discrete_map={'green': 'green', 'red': 'red'},facet_col='sentimentMetric', text=df_plot['label']
                      )
         
         fig.update_xaxes(
@@ -231,8 +273,87 @@ def reviews_percentage_diff(products_or_categories):
         width=1000,
         height=1000
     )
-    fig.update_traces(texttemplate='%{text:.1f}%', textposition='outside')
+    fig.update_traces(texttemplate='%{text}', textposition='outside')
+
+    return fig
+
+
+@instrument('model')
+@st.cache_data(max_entries=256)
+@cache_miss
+def embed_query(text):
+    ## MiniLM is only imported when someone searches by their own text
+    from embeddings import get_embeddings
+
+    return get_embeddings([' ' + clean_text(text)], show_progress_bar=False, use_cache=False)
 
-    print(df_plot)
 
-    return fig
\ No newline at end of file
+@instrument('chart')
+def similar_reviews():
+    try:
+        index = similarity_index()
+    except FileNotFoundError:
+        st.info('The similar-reviews index has not been built yet, run precompute.py')
+        return None
+
+    texts = read_table(TEXTS_PATH)
+    reviews = read_reviews(columns=['id', 'reviews_rating', 'sentiment_label'])
+
+    source = st.radio('Find reviews similar to', ['A review', 'My own text'], horizontal=True)
+    k = st.slider('Number of similar reviews', min_value=5, max_value=50, value=10)
+
+    if source == 'A review':
+        review_id = int(st.number_input('Review id', min_value=0, max_value=len(index) - 1, value=0))
+        st.caption(f"**{texts['reviews_title'].iat[review_id]}**: {texts['reviews_text'].iat[review_id]}")
+        query = np.asarray(index.embeddings[review_id], dtype=np.float32)
+    else:
+        text = st.text_input('Review text')
+        if not text:
+            return None
+        review_id = None
+        query = embed_query(text)
+
+    started = time.perf_counter()
+    ids, scores = index.search(query, k=k + (review_id is not None))
+    elapsed = time.perf_counter() - started
+
+    keep = (ids[0] >= 0) & (ids[0] != review_id)
+    ids, scores = ids[0][keep][:k], scores[0][keep][:k]
+
+    if index.ivf is None:
+        st.caption(f'Exact search over {len(index):,} reviews in {elapsed * 1000:.1f} ms')
+    else:
+        st.caption(f"IVF search over {len(index):,} reviews in {elapsed * 1000:.1f} ms "
+                   f"(recall@{int(index.ivf['k'])} vs exact search: {float(index.ivf['recall']):.1%})")
+
+    return pd.DataFrame({
+        'review_id': ids,
+        'similarity': scores.round(3),
+        'product': reviews['id'].iloc[ids].map(product_names()).to_numpy(),
+        'rating': reviews['reviews_rating'].iloc[ids].to_numpy(),
+        'sentiment': reviews['sentiment_label'].iloc[ids].to_numpy(),
+        'title': texts['reviews_title'].iloc[ids].to_numpy(),
+        'review': texts['reviews_text'].iloc[ids].to_numpy(),
+    })
+
+
+def performance_panel(history):
+    ## history holds the summaries of this session's recorded reruns, the latest last
+    latest = history[-1]
+    events = pd.DataFrame(latest['events'], columns=['name', 'kind', 'ms', 'rss_delta_mb', 'payload_kb'])
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric('This rerun', f"{latest['seconds'] * 1000:.0f} ms")
+    col2.metric('Recorded reruns', len(history))
+    col3.metric('Figure payload', f"{events['payload_kb'].sum():.0f} KB")
+
+    st.subheader('Timings')
+    st.dataframe(events.sort_values('ms', ascending=False), hide_index=True, use_container_width=True)
+
+    st.subheader('Cache counters')
+    counters = pd.DataFrame(sorted(latest['counters'].items()), columns=['counter', 'count'])
+    st.dataframe(counters, hide_index=True, use_container_width=True)
+
+    st.subheader('Reruns')
+    reruns = pd.DataFrame({'rerun': range(1, len(history) + 1), 'ms': [run['seconds'] * 1000 for run in history]})
+    st.line_chart(reruns, x='rerun', y='ms')